@@ -0,0 +1,127 @@
+import collections
+import os
+
+import lm_eval.base
+
+
+def base_lm(lm):
+    """The LM behind the request cache, whose attributes can be inspected."""
+    while isinstance(lm, lm_eval.base.CachingLM):
+        lm = lm.lm
+    return lm
+
+
+def default_bucket_size(lm):
+    """Batch size of the backend, or None if it does not have a fixed one."""
+    try:
+        batch_size = base_lm(lm).batch_size
+    except (AttributeError, NotImplementedError):
+        return None
+    return batch_size if isinstance(batch_size, int) and batch_size > 0 else None
+
+
+def mixed_budgets(lm):
+    """Whether the backend sends every request with its own generation budget.
+
+    Requests of different budgets can then share one call, as with API
+    backends, instead of each budget waiting for the previous one.
+    """
+    return getattr(base_lm(lm), "MIXED_BUDGETS", False)
+
+
+def context_length(lm, context):
+    """Tokenised length of `context`, in characters for LMs without a tokenizer.
+
+    LMs with an `estimate_length` method, such as API backends, measure it
+    themselves without tokenising.
+    """
+    lm = base_lm(lm)
+    if hasattr(lm, "estimate_length"):
+        return lm.estimate_length(context)
+    if hasattr(lm, "tok_encode"):
+        return len(lm.tok_encode(context))
+    return len(context)
+
+
+def generation_budget(args):
+    """Key of everything but the context of a greedy_until request, i.e. how it generates.
+
+    This is the generation spec of the task, its stop sequences and maximal
+    number of generated tokens.
+    """
+    return repr(args[1:])
+
+
+REQUEST_ORDERS = ["length", "prefix"]
+
+
+def prefix_sharing(contexts):
+    """Fraction of the characters of `contexts` shared with the previous context in prefix order.
+
+    This is the part of the prompts a backend with prefix caching can reuse
+    when the requests are sent in prefix-sorted order.
+    """
+    contexts = sorted(contexts)
+    total = sum(map(len, contexts))
+    shared = sum(
+        len(os.path.commonprefix([prev, ctx])) for prev, ctx in zip(contexts, contexts[1:])
+    )
+    return shared / total if total else 0.0
+
+
+def plan_batches(lm, reqtype, requests, bucket_size=None, order="length"):
+    """Split requests pooled across tasks and prompts into batches of similar shape.
+
+    greedy_until requests are grouped by generation budget, so a backend batch
+    never mixes budgets, except for backends taking `mixed_budgets`. With the
+    "length" order they are sorted longest context first within each group, so
+    short sentences are padded to the length of long tables only at the bucket
+    boundaries. With the "prefix" order they are sorted by context instead, so
+    that requests rendered from the same template and few-shot block follow
+    each other and a backend with prefix caching reuses the shared prefix.
+    Other request types keep their order, as the backends already sort them.
+
+    :param requests: list[tuple]
+        Request args, in dispatch order
+    :param bucket_size: int, optional
+        Maximal number of requests per batch. Defaults to the backend batch
+        size, and to one batch per generation budget if it has none (a single
+        batch for backends taking `mixed_budgets`)
+    :param order: str
+        One of `REQUEST_ORDERS`
+    :return: list[list[int]]
+        Positions in `requests` of each batch, every position exactly once
+    """
+    if not requests:
+        return []
+    if reqtype != "greedy_until":
+        return [list(range(len(requests)))]
+
+    if bucket_size is None:
+        bucket_size = default_bucket_size(lm)
+
+    budgets = [generation_budget(args) for args in requests]
+    mixed = mixed_budgets(lm)
+    groups = collections.defaultdict(list)
+    for pos, budget in enumerate(budgets):
+        groups[None if mixed else budget].append(pos)
+
+    lengths = [context_length(lm, args[0]) for args in requests]
+    batches = []
+    for positions in groups.values():
+        if order == "prefix":
+            positions.sort(key=lambda pos: requests[pos][0])
+        else:
+            positions.sort(key=lambda pos: -lengths[pos])
+        step = bucket_size or len(positions)
+        batches.extend(
+            positions[start : start + step] for start in range(0, len(positions), step)
+        )
+
+    padded = sum(max(lengths[pos] for pos in batch) * len(batch) for batch in batches)
+    print(
+        f"Batching {len(requests)} greedy_until requests into {len(batches)} buckets "
+        f"({len(set(budgets))} generation budgets, {sum(lengths) / max(padded, 1):.1%} "
+        f"of padded tokens used)"
+    )
+    return batches
@@ -0,0 +1,176 @@
+"""
+Batch-file mode of ChatLM.
+
+Instead of streaming one API call per request, every greedy_until request
+is written as one line of a JSONL file in the chat-completions batch
+format, which a batch client submits as a single job. Once the job is
+done its output file is read back and mapped to the requests through their
+custom_id.
+"""
+
+import json
+import pathlib
+import time
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# statuses after which a batch job no longer changes
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def write_batch_file(path, requests):
+    """Write `(custom_id, body)` pairs as a chat-completions batch input file."""
+    with open(path, "w", encoding="utf8") as fp:
+        for custom_id, body in requests:
+            line = {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": body,
+            }
+            fp.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+
+def read_batch_output(path):
+    """Return the answer of every custom_id of a batch output file.
+
+    :raises RuntimeError: if any request of the batch failed
+    """
+    answers = {}
+    errors = {}
+    with open(path, "r", encoding="utf8") as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                errors[record["custom_id"]] = record.get("error") or response
+                continue
+            answers[record["custom_id"]] = response["body"]["choices"][0]["message"][
+                "content"
+            ]
+    if errors:
+        first = next(iter(errors.items()))
+        raise RuntimeError(f"{len(errors)} batch requests failed, e.g. {first}")
+    return answers
+
+
+class OpenAIBatchClient:
+    """Batch client of the OpenAI Batch API (files + batches endpoints)."""
+
+    def __init__(self, headers, base_url="https://api.openai.com/v1"):
+        import httpx
+
+        self.base_url = base_url.rstrip("/")
+        self.client = httpx.Client(
+            headers={k: v for k, v in headers.items() if k != "Content-Type"},
+            timeout=120,
+        )
+
+    def submit(self, path):
+        """Upload the batch input file and start the job, return its id."""
+        with open(path, "rb") as fp:
+            r = self.client.post(
+                f"{self.base_url}/files",
+                data={"purpose": "batch"},
+                files={"file": (pathlib.Path(path).name, fp)},
+            )
+        r.raise_for_status()
+        r = self.client.post(
+            f"{self.base_url}/batches",
+            json={
+                "input_file_id": r.json()["id"],
+                "endpoint": BATCH_ENDPOINT,
+                "completion_window": "24h",
+            },
+        )
+        r.raise_for_status()
+        return r.json()["id"]
+
+    def status(self, batch_id):
+        r = self.client.get(f"{self.base_url}/batches/{batch_id}")
+        r.raise_for_status()
+        return r.json()["status"]
+
+    def download(self, batch_id, path):
+        """Write the output file of a finished job to `path`."""
+        r = self.client.get(f"{self.base_url}/batches/{batch_id}")
+        r.raise_for_status()
+        batch = r.json()
+        with open(path, "w", encoding="utf8") as fp:
+            for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+                if file_id:
+                    r = self.client.get(f"{self.base_url}/files/{file_id}/content")
+                    r.raise_for_status()
+                    fp.write(r.text)
+
+
+class LocalBatchClient:
+    """Batch client that executes the batch file itself through a ChatEngine.
+
+    Pointed at a local OpenAI-compatible server, it runs the batch path of
+    ChatLM offline. The job runs when it is submitted, and its output file
+    is written next to the input file.
+    """
+
+    def __init__(self, engine):
+        """
+
+        :param engine: ChatEngine
+            Engine the requests of the batch file are sent through
+        """
+        self.engine = engine
+
+    def submit(self, path):
+        path = pathlib.Path(path)
+        with open(path, "r", encoding="utf8") as fp:
+            lines = [json.loads(line) for line in fp if line.strip()]
+        answers = self.engine.run([line["body"] for line in lines])
+        output = path.with_name(path.stem + "_output.jsonl")
+        with open(output, "w", encoding="utf8") as fp:
+            for line, answer in zip(lines, answers):
+                record = {
+                    "custom_id": line["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {"choices": [{"message": {"content": answer}}]},
+                    },
+                    "error": None,
+                }
+                fp.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return str(output)
+
+    def status(self, batch_id):
+        return "completed"
+
+    def download(self, batch_id, path):
+        if pathlib.Path(batch_id) != pathlib.Path(path):
+            pathlib.Path(path).write_text(
+                pathlib.Path(batch_id).read_text(encoding="utf8"), encoding="utf8"
+            )
+
+
+def run_batch_job(client, path, requests, poll_interval=60):
+    """Submit `(custom_id, body)` pairs as one batch job and wait for its answers.
+
+    :return: list[str]
+        Answers in the order of `requests`
+    """
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write_batch_file(path, requests)
+
+    batch_id = client.submit(path)
+    print(f"Submitted batch {batch_id} of {len(requests)} requests")
+    status = client.status(batch_id)
+    while status not in FINAL_STATUSES:
+        time.sleep(poll_interval)
+        status = client.status(batch_id)
+        print(f"Batch {batch_id}: {status}")
+    if status != "completed":
+        raise RuntimeError(f"Batch {batch_id} ended with status {status}")
+
+    output = path.with_name(path.stem + "_output.jsonl")
+    client.download(batch_id, output)
+    answers = read_batch_output(output)
+    return [answers[custom_id] for custom_id, _ in requests]
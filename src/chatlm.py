@@ -1,66 +1,805 @@
 import os
 import asyncio
+import json
+import collections
+import email.utils
+import functools
+import logging
+import random
+import re
 import numpy as np
-import transformers
-from lm_eval.base import BaseLM
+from lm_eval.base import BaseLM, hash_args
 from lm_eval import utils
 from tqdm import tqdm
-import backoff
+import pathlib
+import threading
 import time
 
+from chatbatch import LocalBatchClient, OpenAIBatchClient, run_batch_job
 
-@backoff.on_exception(backoff.expo, Exception)
-async def single_chat(client, **kwargs):
-    r = await client.post(**kwargs, timeout=20)
-    json_response = r.json()
-    s = json_response['choices'][0]["message"]['content']
-    return s
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
 
+logger = logging.getLogger(__name__)
 
-async def oa_completion(**kwargs):
-    """Query OpenAI API for completion.
 
-    Retry with back-off until they respond
+# prompts whose GPT-2 length is kept, enough for the requests of a few batches
+TOKEN_LENGTH_CACHE_SIZE = 4096
+
+
+def char_length(text):
+    """Rough token count of `text`, at about 4 ASCII characters per token.
+
+    Other characters, e.g. Chinese, are mostly a token each or more, so they
+    count as one token each and the tokens-per-minute budget is not overrun.
     """
-    import httpx
-
-    async with httpx.AsyncClient() as client:
-        tasks = [single_chat(
-            client=client,
-            url=kwargs["url"], headers=kwargs["headers"],
-            json={
-                "temperature": kwargs["temperature"], "max_tokens": kwargs["max_tokens"],
-                "model": kwargs["model"], "messages": [message,],
-            }
-        ) for message in kwargs["messages"]]
-        results = await asyncio.gather(*tasks)
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return ascii_chars // 4 + len(text) - ascii_chars
+
+
+def request_until(args):
+    """Stop sequences of greedy_until request args, as a list."""
+    until = args[1].get("until") if isinstance(args[1], dict) else args[1]
+    if until is None:
+        return []
+    return [until] if isinstance(until, str) else list(until)
+
+
+def request_max_tokens(args, default):
+    """Generation budget of greedy_until request args, `default` if the task sets none."""
+    if isinstance(args[1], dict) and args[1].get("max_length"):
+        return int(args[1]["max_length"])
+    return default
+
+
+@functools.lru_cache(maxsize=None)
+def answer_word_pattern(answer_words):
+    """Regex finding any of `answer_words` as a whole word, None if there are none.
+
+    An end of a word in ASCII letters or digits has to be a word boundary, so
+    "no" is not found in "not" or "know". Words in scripts written without
+    spaces, such as Chinese, are found anywhere.
+    """
+    alternatives = []
+    for word in answer_words:
+        if not word:
+            continue
+        pattern = re.escape(word)
+        if word[0].isascii() and word[0].isalnum():
+            pattern = r"\b" + pattern
+        if word[-1].isascii() and word[-1].isalnum():
+            pattern = pattern + r"\b"
+        alternatives.append(pattern)
+    return re.compile("|".join(alternatives)) if alternatives else None
+
+
+def stream_stop(text, until=(), answer_words=None):
+    """Where a streamed answer can be cut, None while it has to go on.
+
+    The answer is cut before the first `until` sequence. With `answer_words`,
+    the answer is complete once one of them has arrived as a whole word, see
+    `answer_word_pattern`, or once a newline ends the first non-empty line.
+    """
+    cuts = [text.find(stop) for stop in until if stop and stop in text]
+    if cuts:
+        return text[: min(cuts)]
+    if answer_words is not None:
+        pattern = answer_word_pattern(tuple(answer_words))
+        if pattern is not None and pattern.search(text.lower()):
+            return text
+        start = len(text) - len(text.lstrip())
+        end = text.find("\n", start)
+        if end != -1:
+            return text[:end]
+    return None
+
+
+def parse_duration(value):
+    """Seconds of a rate limit reset such as "20ms", "1.5s" or "6m0s"."""
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return float(value)
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def retry_after(headers):
+    """Seconds to wait according to a Retry-After header, None if absent."""
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        return float(value) / 1000
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value)
+        return max(date.timestamp() - time.time(), 0.0)
+
+
+class TokenBucket:
+    """Budget of `per_minute` units, refilled continuously.
+
+    APIs also enforce their per-minute limits over shorter windows, so the
+    bucket only holds `burst` seconds worth of units instead of a full minute.
+    """
+
+    def __init__(self, per_minute, burst=1.0):
+        self.rate = float(per_minute) / 60
+        self.capacity = max(self.rate * burst, 1.0)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` units are available."""
+        self._refill(now)
+        # a request larger than the bucket waits for a full bucket and leaves
+        # it in debt, which the following requests wait out
+        amount = min(amount, self.capacity)
+        return max(amount - self.level, 0.0) / self.rate
+
+    def take(self, amount):
+        self.level -= amount
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute scheduler of a ChatEngine.
+
+    Requests wait in order until both budgets allow them. The budgets start
+    from the configured limits, or from the `x-ratelimit-limit-*` headers of
+    the API when none are configured, and every request waits while the API
+    reports an exhausted budget or asks to retry later, so a 429 pauses all
+    requests once instead of each one retrying on its own.
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        """
+
+        :param rpm: int, optional
+            Requests per minute
+        :param tpm: int, optional
+            Tokens per minute, prompt and generation
+        """
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.paused_until = 0.0
+        self._lock = None
+
+    async def acquire(self, tokens):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if self.requests is not None:
+                    wait = max(wait, self.requests.wait_time(1, now))
+                if self.tokens is not None:
+                    wait = max(wait, self.tokens.wait_time(tokens, now))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update(self, headers):
+        """Follow the `x-ratelimit-*` headers of a response."""
+        for kind in ("requests", "tokens"):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            if limit is not None and getattr(self, kind) is None:
+                setattr(self, kind, TokenBucket(float(limit)))
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            reset = headers.get(f"x-ratelimit-reset-{kind}")
+            if remaining is not None and reset is not None and float(remaining) <= 0:
+                self.pause(parse_duration(reset))
+
+
+class Endpoint:
+    """An OpenAI-compatible chat completions server and its share of the load."""
+
+    def __init__(
+        self,
+        url,
+        headers,
+        weight=1.0,
+        concurrency=20,
+        limiter=None,
+        health_url=None,
+    ):
+        """
+
+        :param url: str
+            Chat completions URL
+        :param headers: dict
+            Headers of every request, with the API key of this endpoint
+        :param weight: float
+            Relative share of the requests this endpoint should serve
+        :param concurrency: int
+            Maximal number of requests in flight on this endpoint
+        :param limiter: RateLimiter, optional
+            Scheduler of the requests of this endpoint. Defaults to one following the API headers only
+        :param health_url: str, optional
+            URL probed by the health checks
+        """
+        self.url = url
+        self.headers = headers
+        self.weight = float(weight)
+        self.concurrency = int(concurrency)
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.health_url = health_url
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    @classmethod
+    def from_config(cls, config, default_key=None):
+        """Endpoint of a `{"base_url", "api_key", "weight", "concurrency", "rpm", "tpm"}` entry.
+
+        The key can also be read from the environment variable named by
+        `api_key_env`, and defaults to `default_key`.
+        """
+        base_url = config["base_url"].rstrip("/")
+        api_key = config.get("api_key") or os.environ.get(
+            config.get("api_key_env", ""), default_key
+        )
+        headers = {"Content-Type": "application/json"}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        return cls(
+            f"{base_url}/chat/completions",
+            headers,
+            weight=config.get("weight", 1.0),
+            concurrency=config.get("concurrency", 20),
+            limiter=RateLimiter(rpm=config.get("rpm"), tpm=config.get("tpm")),
+            health_url=f"{base_url}/models",
+        )
+
+
+class EndpointPool:
+    """Least-outstanding-requests balancer over the endpoints of a ChatEngine.
+
+    A request goes to the available endpoint with the fewest requests in
+    flight relative to its weight. An endpoint that fails `EJECT_AFTER` times
+    in a row, or fails a health check, is out of rotation for `EJECT_SECONDS`
+    or until a health check succeeds again. With a single endpoint nothing is
+    ever ejected, as there is nothing to fail over to.
+    """
+
+    EJECT_AFTER = 3
+    EJECT_SECONDS = 30.0
+
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self._changed = None
+
+    @property
+    def concurrency(self):
+        return sum(endpoint.concurrency for endpoint in self.endpoints)
+
+    async def acquire(self):
+        """Wait for an endpoint with a free slot and take the slot."""
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        while True:
+            now = time.monotonic()
+            available = [
+                endpoint
+                for endpoint in self.endpoints
+                if endpoint.ejected_until <= now
+                and endpoint.outstanding < endpoint.concurrency
+            ]
+            if available:
+                endpoint = min(available, key=lambda e: (e.outstanding + 1) / e.weight)
+                endpoint.outstanding += 1
+                return endpoint
+
+            # wait for a slot to be released or an ejection to end
+            ejections = [e.ejected_until for e in self.endpoints if e.ejected_until > now]
+            timeout = min(ejections) - now if ejections else None
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, endpoint, healthy=None):
+        """Give back the slot of a request, `healthy` tells how the endpoint answered."""
+        endpoint.outstanding -= 1
+        if healthy:
+            endpoint.failures = 0
+        elif healthy is not None:
+            endpoint.failures += 1
+            if endpoint.failures >= self.EJECT_AFTER:
+                self.eject(endpoint)
+        if self._changed is not None:
+            self._changed.set()
+
+    def eject(self, endpoint):
+        if len(self.endpoints) > 1:
+            if endpoint.ejected_until <= time.monotonic():
+                print(f"Taking {endpoint.url} out of rotation for {self.EJECT_SECONDS}s")
+            endpoint.ejected_until = time.monotonic() + self.EJECT_SECONDS
+
+    def reinstate(self, endpoint):
+        endpoint.failures = 0
+        endpoint.ejected_until = 0.0
+        if self._changed is not None:
+            self._changed.set()
+
+    async def health_check(self, client, interval=15.0):
+        """Probe every endpoint each `interval` seconds, forever."""
+        while True:
+            for endpoint in self.endpoints:
+                if endpoint.health_url is None:
+                    continue
+                try:
+                    r = await client.get(
+                        endpoint.health_url, headers=endpoint.headers, timeout=5
+                    )
+                    healthy = r.status_code < 500
+                except Exception:
+                    healthy = False
+                if not healthy:
+                    self.eject(endpoint)
+                elif endpoint.ejected_until > time.monotonic():
+                    self.reinstate(endpoint)
+            await asyncio.sleep(interval)
+
+
+class ChatEngine:
+    """Long-lived async engine that sends chat completions over a shared connection pool.
+
+    The engine runs its own event loop in a background thread, so the pool
+    outlives each `greedy_until` call. At most the summed concurrency of the
+    endpoints is in flight over the whole request list: as soon as one
+    returns the next one is sent, so a slow response only holds its own slot
+    instead of a whole chunk. Requests are spread over the endpoints by an
+    `EndpointPool`.
+
+    With a hedge budget, a request still waiting after the rolling p95 latency
+    is sent a second time; the first answer is kept and the other cancelled.
+    """
+
+    # latencies kept for the rolling p95, and how many are needed before hedging
+    LATENCY_WINDOW = 200
+    HEDGE_MIN_SAMPLES = 20
+
+    def __init__(
+        self,
+        endpoints,
+        max_retries=6,
+        timeout=20,
+        backoff_base=1.0,
+        backoff_cap=60.0,
+        hedge_budget=0,
+        stream=False,
+    ):
+        """
+
+        :param endpoints: list[Endpoint]
+            Servers the requests are balanced over
+        :param max_retries: int
+            Retries of a request after a timeout, 429 or server error before giving up
+        :param timeout: float
+            Seconds before a request times out
+        :param backoff_base: float
+            Upper bound of the first jittered retry delay, doubled on every retry
+        :param backoff_cap: float
+            Upper bound of any jittered retry delay
+        :param hedge_budget: int
+            Maximal number of hedged duplicate requests over the lifetime of the engine
+        :param stream: bool
+            Stream the answers, so that they can be cut short by a stop function
+        """
+        self.pool = EndpointPool(endpoints)
+        self.concurrency = self.pool.concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        # own generator, so retries do not consume the global random state
+        self.rnd = random.Random()
+        self.hedge_budget = hedge_budget
+        self.hedges_sent = 0
+        self.hedge_wins = 0
+        self.latencies = collections.deque(maxlen=self.LATENCY_WINDOW)
+        self.stream = stream
+        # seconds until each request of the last `run` had its answer
+        self.answer_times = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.client = self._submit(self._open_client()).result()
+        self.health_checks = None
+        if len(endpoints) > 1:
+            self.health_checks = self._submit(self.pool.health_check(self.client))
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def _open_client(self):
+        import httpx
+
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.concurrency,
+                max_keepalive_connections=self.concurrency,
+            )
+        )
+
+    def run(self, payloads, tokens=None, progress=None, stops=None):
+        """Send the request bodies and return the responses in their original order.
+
+        :param tokens: list[int], optional
+            Estimated prompt and generation tokens of each request, for the tokens-per-minute budget
+        :param progress: tqdm, optional
+            Progress bar updated as each response returns
+        :param stops: list[Callable], optional
+            With streaming, function of each request returning the cut answer
+            once the partial answer is complete, see `stream_stop`
+        """
+        if tokens is None:
+            tokens = [0] * len(payloads)
+        if stops is None:
+            stops = [None] * len(payloads)
+        return self._submit(self._run(payloads, tokens, stops, progress)).result()
+
+    def backoff(self, attempt):
+        """Full-jitter exponential delay before retry number `attempt`."""
+        return self.rnd.uniform(
+            0, min(self.backoff_cap, self.backoff_base * 2**attempt)
+        )
+
+    async def _post(self, endpoint, payload, stop):
+        """Send one chat completion, return the response and its answer (None on error)."""
+        if not self.stream:
+            r = await self.client.post(
+                endpoint.url, headers=endpoint.headers, json=payload, timeout=self.timeout
+            )
+            if not r.is_success:
+                return r, None
+            return r, r.json()["choices"][0]["message"]["content"]
+
+        async with self.client.stream(
+            "POST",
+            endpoint.url,
+            headers=endpoint.headers,
+            json={**payload, "stream": True},
+            timeout=self.timeout,
+        ) as r:
+            if not r.is_success:
+                await r.aread()
+                return r, None
+            text = ""
+            async for line in r.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices")
+                if not choices:
+                    continue
+                text += choices[0].get("delta", {}).get("content") or ""
+                if stop is not None:
+                    cut = stop(text)
+                    if cut is not None:
+                        # leaving the block closes the stream before the rest is generated
+                        return r, cut
+            return r, text
+
+    async def request(self, payload, tokens, stop=None, sent=None):
+        """Send one chat completion within the rate limits, retrying transient failures.
+
+        :param sent: asyncio.Event, optional
+            Set once the request has an endpoint slot and its rate limits
+            allow it, as it is actually sent
+        """
+        import httpx
+
+        for attempt in range(self.max_retries + 1):
+            endpoint = await self.pool.acquire()
+            healthy = None
+            try:
+                await endpoint.limiter.acquire(tokens)
+                if sent is not None:
+                    sent.set()
+                start = time.monotonic()
+                try:
+                    r, answer = await self._post(endpoint, payload, stop)
+                except httpx.TransportError:
+                    # timeouts and dropped connections
+                    healthy = False
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self.backoff(attempt)
+                else:
+                    healthy = r.status_code < 500
+                    endpoint.limiter.update(r.headers)
+                    if r.status_code in RETRY_STATUS and attempt < self.max_retries:
+                        delay = retry_after(r.headers)
+                        if delay is None:
+                            delay = self.backoff(attempt)
+                        if r.status_code == 429:
+                            endpoint.limiter.pause(delay)
+                    else:
+                        r.raise_for_status()
+                        self.latencies.append(time.monotonic() - start)
+                        return answer
+            finally:
+                self.pool.release(endpoint, healthy)
+            await asyncio.sleep(delay)
+
+    def latency_p95(self):
+        """Rolling p95 latency of successful requests, None until enough have returned."""
+        if len(self.latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+        return float(np.percentile(self.latencies, 95))
+
+    async def hedged_request(self, payload, tokens, stop=None):
+        """`request`, duplicated once it has waited longer than the rolling p95 latency.
+
+        The wait is counted from when the request is actually sent, as the
+        p95 does not include the time spent queueing for an endpoint slot or
+        the rate limits.
+        """
+        sent = asyncio.Event()
+        primary = asyncio.ensure_future(self.request(payload, tokens, stop, sent))
+        threshold = self.latency_p95()
+        if threshold is None or self.hedges_sent >= self.hedge_budget:
+            return await primary
+
+        sending = asyncio.ensure_future(sent.wait())
+        try:
+            await asyncio.wait({primary, sending}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            sending.cancel()
+        done, _ = await asyncio.wait({primary}, timeout=threshold)
+        if done or self.hedges_sent >= self.hedge_budget:
+            return await primary
+
+        self.hedges_sent += 1
+        hedge = asyncio.ensure_future(self.request(payload, tokens, stop))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in sorted(done, key=lambda t: t.exception() is not None):
+                    # a failed copy leaves the answer to the other one
+                    if task.exception() is None or not pending:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def hedge_stats(self):
+        return {
+            "hedge_budget": self.hedge_budget,
+            "hedges_sent": self.hedges_sent,
+            "hedge_wins": self.hedge_wins,
+            "latency_p95": self.latency_p95(),
+        }
+
+    async def _run(self, payloads, tokens, stops, progress):
+        results = [None] * len(payloads)
+        self.answer_times = [None] * len(payloads)
+        # shared by the workers, each takes the next request once its own returns
+        pending = iter(enumerate(zip(payloads, tokens, stops)))
+
+        async def worker():
+            for i, (payload, n_tokens, stop) in pending:
+                start = time.monotonic()
+                results[i] = await self.hedged_request(payload, n_tokens, stop)
+                self.answer_times[i] = time.monotonic() - start
+                if progress is not None:
+                    progress.update(1)
+
+        workers = [
+            asyncio.ensure_future(worker())
+            for _ in range(min(self.concurrency, len(payloads)))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for w in workers:
+                w.cancel()
+            raise
         return results
 
+    def close(self):
+        if self.health_checks is not None:
+            self.health_checks.cancel()
+        self._submit(self.client.aclose()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
 
-class ChatLM(BaseLM):
-    REQ_CHUNK_SIZE = 20
 
-    def __init__(self, model, truncate=False):
+class ChatLM(BaseLM):
+    API_URL = "https://api.openai.com/v1/chat/completions"
+    # every request is sent with its own max_tokens and stop, so requests of
+    # all generation budgets go out in one greedy_until call
+    MIXED_BUDGETS = True
+
+    def __init__(
+        self,
+        model,
+        truncate=False,
+        length_estimator=None,
+        concurrency=20,
+        rpm=None,
+        tpm=None,
+        max_retries=6,
+        hedge_budget=0,
+        api_url=None,
+        endpoints=None,
+        stream=False,
+        batch=None,
+        batch_dir="chat_batches",
+        poll_interval=60,
+    ):
         """
 
         :param model: str
         :param truncate: bool
             Truncate input if too long (if False and input is too long, throw error)
+        :param length_estimator: str or Callable, optional
+            How the length of a prompt is estimated to order the requests and
+            budget the tokens per minute: "chars" (about 4 ASCII characters per
+            token, one per other character), "tokens" (exact GPT-2 tokenisation) or a function of the
+            prompt. Defaults to "tokens" with `truncate` and to "chars" otherwise
+        :param concurrency: int
+            Maximal number of API requests in flight
+        :param rpm: int, optional
+            Requests-per-minute budget. Defaults to the limit reported by the API
+        :param tpm: int, optional
+            Tokens-per-minute budget. Defaults to the limit reported by the API
+        :param max_retries: int
+            Retries of a request after a timeout, 429 or server error
+        :param hedge_budget: int
+            Maximal number of duplicate requests sent for requests slower than the rolling p95
+        :param api_url: str, optional
+            Chat completions endpoint. Defaults to the OpenAI API
+        :param endpoints: str, optional
+            JSON or YAML file listing OpenAI-compatible servers to balance the
+            requests over, each a mapping with `base_url` and optionally
+            `api_key` (or `api_key_env`), `weight`, `concurrency`, `rpm` and `tpm`.
+            Replaces `api_url`, `concurrency`, `rpm` and `tpm`
+        :param stream: bool
+            Stream the answers and close each stream once the request's `until`
+            sequence, or for classification tasks an answer word or the end
+            of the answer line, has arrived
+        :param batch: str, optional
+            "openai" to send greedy_until requests as OpenAI batch jobs, "local" to
+            execute the batch files against `api_url`, e.g. a local server
+        :param batch_dir: str
+            Directory of the batch input and output files
+        :param poll_interval: float
+            Seconds between two status checks of a batch job
         """
         super().__init__()
 
         import openai
 
         self.model = model
-        self.truncate = truncate
+        self.truncate = truncate in (True, "True", "true", "1")
+        if length_estimator is None:
+            length_estimator = "tokens" if self.truncate else "chars"
+        if length_estimator == "chars":
+            length_estimator = char_length
+        elif length_estimator == "tokens":
+            # the same prompts are tokenised to plan the batches and to order them
+            length_estimator = functools.lru_cache(maxsize=TOKEN_LENGTH_CACHE_SIZE)(
+                lambda text: len(self.tok_encode(text))
+            )
+        elif not callable(length_estimator):
+            raise ValueError(f"Unknown length estimator {length_estimator}")
+        self.estimate_length = length_estimator
+        self.concurrency = int(concurrency)
+        self.rpm = int(rpm) if rpm else None
+        self.tpm = int(tpm) if tpm else None
+        self.max_retries = int(max_retries)
+        self.hedge_budget = int(hedge_budget)
+        self.api_url = api_url or self.API_URL
+        self.endpoints = endpoints
+        self.stream = stream in (True, "True", "true", "1")
+        self.batch = batch
+        self.batch_dir = pathlib.Path(batch_dir)
+        self.poll_interval = float(poll_interval)
+        self._engine = None
+        self._batch_client = None
+        self._batches_sent = 0
+        # request hash -> origin of the request in the evaluator, for batch custom_ids
+        self.request_origins = {}
+        # request hash -> words completing the answer, for closing streams early
+        self.answer_words = {}
         # Read from environment variable OPENAI_API_SECRET_KEY
-        api_key = os.environ["OPENAI_API_SECRET_KEY"]
-        self.tokenizer = transformers.GPT2TokenizerFast.from_pretrained("gpt2")
+        api_key = (
+            os.environ.get("OPENAI_API_SECRET_KEY")
+            if endpoints
+            else os.environ["OPENAI_API_SECRET_KEY"]
+        )
+        self.api_key = api_key
+        self._tokenizer = None
         self.headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {api_key}"
         }
 
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._engine = ChatEngine(
+                self.load_endpoints(),
+                max_retries=self.max_retries,
+                hedge_budget=self.hedge_budget,
+                stream=self.stream,
+            )
+        return self._engine
+
+    def load_endpoints(self):
+        if not self.endpoints:
+            return [
+                Endpoint(
+                    self.api_url,
+                    self.headers,
+                    concurrency=self.concurrency,
+                    limiter=RateLimiter(rpm=self.rpm, tpm=self.tpm),
+                )
+            ]
+
+        with open(self.endpoints, "r", encoding="utf8") as f:
+            if self.endpoints.endswith((".yaml", ".yml")):
+                import yaml
+
+                configs = yaml.safe_load(f)
+            else:
+                configs = json.load(f)
+        return [Endpoint.from_config(config, self.api_key) for config in configs]
+
+    @property
+    def batch_client(self):
+        if self._batch_client is None:
+            if self.batch == "openai":
+                self._batch_client = OpenAIBatchClient(self.headers)
+            elif self.batch == "local":
+                self._batch_client = LocalBatchClient(self.engine)
+            else:
+                raise ValueError(f"Unknown batch mode {self.batch}")
+        return self._batch_client
+
+    def hedge_stats(self):
+        if self._engine is None:
+            return {"hedge_budget": self.hedge_budget, "hedges_sent": 0, "hedge_wins": 0}
+        return self._engine.hedge_stats()
+
+    def close(self):
+        if self._engine is not None:
+            self._engine.close()
+            self._engine = None
+
+    @property
+    def tokenizer(self):
+        # only needed to truncate or measure prompts exactly, so loaded on first use
+        if self._tokenizer is None:
+            import transformers
+
+            self._tokenizer = transformers.GPT2TokenizerFast.from_pretrained("gpt2")
+        return self._tokenizer
+
     @property
     def eot_token_id(self):
         return self.tokenizer.eos_token_id
@@ -72,6 +811,7 @@ class ChatLM(BaseLM):
 
     @property
     def max_gen_toks(self):
+        # budget of requests whose task does not set one
         return 10
 
     @property
@@ -99,52 +839,109 @@ class ChatLM(BaseLM):
         res = []
 
         def _collate(x):
-            toks = self.tok_encode(x[0])
-            return len(toks), x[0]
+            # longest first, so the slowest requests do not straggle at the end
+            return -self.estimate_length(x[0]), x[0]
 
         re_ord = utils.Reorderer(requests, _collate)
 
-        def sameuntil_chunks(xs, size):
-            ret = []
-            lastuntil = "</s>"
-            for x in xs:
-                if len(ret) >= size:
-                    yield ret, lastuntil
-                    ret = []
-                    lastuntil = "</s>"
-                ret.append(x)
-
-            if ret:
-                yield ret, lastuntil
-
-        # todo: more intelligent batching for heterogeneous `until`
-        for chunk, until in tqdm(
-            list(sameuntil_chunks(re_ord.get_reordered(), self.REQ_CHUNK_SIZE))
-        ):
-            inps = []
-            for context in chunk:
-                inps.append(context[0])
-
-            responses = asyncio.run(oa_completion(
-                url="https://api.openai.com/v1/chat/completions",
-                headers=self.headers,
-                model=self.model,
-                messages=[{"role": "user", "content": inp} for inp in inps],
-                max_tokens=self.max_gen_toks,
-                temperature=0.0,
-                # stop=until,
-            ))
-
-            for resp, context in zip(responses, chunk):
-                s = resp
-
-                # partial caching
-                self.cache_hook.add_partial("greedy_until", (context, "</s>"), s)
-
-                res.append(s)
+        reordered = re_ord.get_reordered()
+        payloads = []
+        for request in reordered:
+            max_tokens = request_max_tokens(request, self.max_gen_toks)
+            payload = {
+                "temperature": 0.0,
+                "max_tokens": max_tokens,
+                "model": self.model,
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": self.truncate_context(request[0], max_tokens),
+                    }
+                ],
+            }
+            until = request_until(request)
+            if until:
+                # the API accepts at most 4 stop sequences
+                payload["stop"] = until[:4]
+            payloads.append(payload)
+        if self.batch:
+            responses = self._batch_greedy_until(reordered, payloads)
+        else:
+            # estimated prompt length plus the generation budget
+            tokens = [
+                self.estimate_length(request[0]) + payload["max_tokens"]
+                for request, payload in zip(reordered, payloads)
+            ]
+            stops = [
+                functools.partial(
+                    stream_stop,
+                    until=request_until(request),
+                    answer_words=self.answer_words.get(hash_args("greedy_until", request)),
+                )
+                for request in reordered
+            ]
+            with tqdm(total=len(payloads)) as progress:
+                responses = self.engine.run(
+                    payloads, tokens=tokens, progress=progress, stops=stops
+                )
+            self.log_answer_times(reordered)
+
+        for resp, context in zip(responses, reordered):
+            s = resp
+
+            # partial caching
+            self.cache_hook.add_partial("greedy_until", (context, "</s>"), s)
+
+            res.append(s)
 
         return re_ord.get_original(res)
 
+    def truncate_context(self, context, max_tokens):
+        """Keep the end of the prompt that fits the context window with `truncate`."""
+        if not self.truncate:
+            return context
+        budget = self.max_length - max_tokens
+        toks = self.tok_encode(context)
+        if len(toks) <= budget:
+            return context
+        return self.tok_decode(toks[-budget:])
+
+    def log_answer_times(self, requests):
+        times = self.engine.answer_times
+        for request, seconds in zip(requests, times):
+            origin = self.request_origins.get(hash_args("greedy_until", request))
+            logger.info("time to answer %s: %.3fs", origin, seconds)
+        if times:
+            print(
+                "Time to answer: mean {:.3f}s, p50 {:.3f}s, p95 {:.3f}s".format(
+                    np.mean(times), np.percentile(times, 50), np.percentile(times, 95)
+                )
+            )
+
+    def _batch_greedy_until(self, requests, payloads):
+        """Send the requests as one batch job, identified by their evaluator origin."""
+        custom_ids = []
+        seen = collections.Counter()
+        for n, request in enumerate(requests):
+            origin = self.request_origins.get(hash_args("greedy_until", request))
+            custom_id = origin if origin is not None else f"request-{n}"
+            # identical requests of the same origin still need distinct ids
+            seen[custom_id] += 1
+            if seen[custom_id] > 1:
+                custom_id = f"{custom_id}#{seen[custom_id]}"
+            custom_ids.append(custom_id)
+
+        self._batches_sent += 1
+        path = self.batch_dir.joinpath(
+            "batch_{}_{}.jsonl".format(time.strftime("%Y%m%d-%H%M%S"), self._batches_sent)
+        )
+        return run_batch_job(
+            self.batch_client,
+            path,
+            list(zip(custom_ids, payloads)),
+            poll_interval=self.poll_interval,
+        )
+
     def _model_call(self, inps):
         # Isn't used because we override _loglikelihood_tokens
         raise NotImplementedError()
@@ -0,0 +1,75 @@
+import collections
+
+
+DispatchItem = collections.namedtuple(
+    "DispatchItem", ["req", "origin", "dialogue", "turn"]
+)
+
+
+class TurnDispatcher:
+    """Schedule requests per dialogue, releasing a turn once its predecessors returned.
+
+    Docs without a dialogue are one-turn dialogues, so they all go out in the
+    first batch. For multi-turn tasks such as ConvFinQA, turn t+1 of a dialogue
+    is released as soon as turn t of that same dialogue has a response; other
+    dialogues do not have to reach turn t first, and every request is sent to
+    the LM exactly once.
+    """
+
+    def __init__(self):
+        # dialogue -> turn -> [(task, req, origin)]
+        self.pending = collections.OrderedDict()
+        # dialogue -> turn -> response
+        self.history = collections.defaultdict(dict)
+        self.in_flight = collections.Counter()
+        self.max_turn = 0
+
+    def add(self, task, req, origin, dialogue, turn):
+        """Queue `req` as turn `turn` of `dialogue`.
+
+        :param dialogue: hashable
+            Key of the dialogue, unique across tasks and prompt variants
+        :param origin: tuple
+            Opaque origin of the request, handed back with the batch
+        """
+        turns = self.pending.setdefault(dialogue, collections.defaultdict(list))
+        turns[turn].append((task, req, origin))
+        self.max_turn = max(self.max_turn, turn)
+
+    def __len__(self):
+        return sum(
+            len(items) for turns in self.pending.values() for items in turns.values()
+        )
+
+    def next_batch(self):
+        """Return every request whose dialogue has no turn left in flight.
+
+        Requests are reformulated with the responses of the earlier turns of
+        their own dialogue before they are returned.
+        """
+        batch = []
+        for dialogue in list(self.pending):
+            if self.in_flight[dialogue]:
+                continue
+            turns = self.pending[dialogue]
+            turn = min(turns)
+            history = [(self.history[dialogue].get(t), t) for t in range(turn)]
+            for task, req, origin in turns.pop(turn):
+                req = task.reformulate_turn_req(req, history, turn)
+                batch.append(DispatchItem(req, origin, dialogue, turn))
+                self.in_flight[dialogue] += 1
+            if not turns:
+                del self.pending[dialogue]
+        return batch
+
+    def complete(self, items, resps):
+        """Record the responses of (part of) a batch returned by `next_batch`."""
+        for item, resp in zip(items, resps):
+            self.in_flight[item.dialogue] -= 1
+            if not self.in_flight[item.dialogue]:
+                del self.in_flight[item.dialogue]
+            if item.dialogue in self.pending:
+                self.history[item.dialogue][item.turn] = resp
+            elif item.dialogue not in self.in_flight:
+                # finished dialogues no longer need their history
+                self.history.pop(item.dialogue, None)
@@ -2,6 +2,7 @@ import argparse
 import json
 import logging
 import os
+import suite
 import tasks
 
 from lm_eval import utils
@@ -13,7 +14,7 @@ logging.getLogger("openai").setLevel(logging.WARNING)
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--model", required=True)
+    parser.add_argument("--model", default=None)
     parser.add_argument("--model_args", default="")
     parser.add_argument(
         "--tasks", default=None, choices=utils.MultiChoice(tasks.ALL_TASKS)
@@ -31,6 +32,18 @@ def parse_args():
         help="Maximal batch size to try with --batch_size auto",
     )
     parser.add_argument("--device", type=str, default=None)
+    parser.add_argument(
+        "--bucket_size",
+        type=int,
+        default=None,
+        help="Maximal number of generation requests per length-bucketed backend batch",
+    )
+    parser.add_argument(
+        "--request_order",
+        default="length",
+        choices=["length", "prefix"],
+        help="Send generation requests longest first, or prefix-sorted for backends with prefix caching",
+    )
     parser.add_argument("--output_path", default=None)
     parser.add_argument(
         "--limit",
@@ -46,9 +59,91 @@ def parse_args():
     parser.add_argument("--check_integrity", action="store_true")
     parser.add_argument("--write_out", action="store_true", default=False)
     parser.add_argument("--output_base_path", type=str, default=None)
+    parser.add_argument(
+        "--write_out_compress",
+        action="store_true",
+        default=False,
+        help="Gzip the write_out JSONL files",
+    )
     parser.add_argument("--faireval_repeat_per_prompt", action="store_true")
+    parser.add_argument(
+        "--run_dir",
+        default=None,
+        help="Directory in which responses are journaled as they return",
+    )
+    parser.add_argument(
+        "--resume",
+        default=None,
+        help="Run directory of an interrupted run to resume from its journal",
+    )
+    parser.add_argument(
+        "--results_db",
+        default="results.db",
+        help="SQLite ledger that faireval per-prompt results are appended to",
+    )
+    parser.add_argument("--run_id", default=None)
+    parser.add_argument(
+        "--suite",
+        default=None,
+        help="YAML/JSON suite file of tasks to run with a single load of the model",
+    )
+
+    args = parser.parse_args()
+    if args.model is None and args.suite is None:
+        parser.error("--model is required unless it is given by --suite")
+    return args
+
 
-    return parser.parse_args()
+def report(results, output_path, model, model_args, limit, num_fewshot, batch_size):
+    dumped = json.dumps(results, indent=2)
+    print(dumped)
+
+    if output_path:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "w") as f:
+            f.write(dumped)
+
+    batch_sizes = ",".join(map(str, results["config"]["batch_sizes"]))
+    print(
+        f"{model} ({model_args}), limit: {limit}, provide_description: False, "
+        f"num_fewshot: {num_fewshot}, batch_size: {batch_size}{f' ({batch_sizes})' if batch_sizes else ''}"
+    )
+    print(evaluator.make_table(results))
+
+
+def run_suite(args):
+    model_settings, entries = suite.load_suite(args.suite)
+    # command line model settings fill in those the suite leaves out
+    for key in suite.MODEL_KEYS:
+        if key not in model_settings and getattr(args, key) not in (None, ""):
+            model_settings[key] = getattr(args, key)
+    if "model" not in model_settings:
+        raise ValueError("The suite names no model, pass it with --model")
+
+    # a task name can be a pattern, which runs every matching task with its settings
+    entries = [
+        {**entry, "name": task_name}
+        for entry in entries
+        for task_name in utils.pattern_match([entry["name"]], tasks.ALL_TASKS)
+    ]
+    print(f"Selected Tasks: {[entry['name'] for entry in entries]}")
+
+    for entry, results in evaluator.simple_evaluate_suite(
+        entries,
+        results_db=args.results_db,
+        run_id=args.run_id,
+        resume=args.resume,
+        **model_settings,
+    ):
+        report(
+            results,
+            entry.get("output_path"),
+            model_settings["model"],
+            model_settings.get("model_args", ""),
+            entry.get("limit"),
+            entry.get("num_fewshot", 0),
+            model_settings.get("batch_size"),
+        )
 
 
 def main():
@@ -56,6 +151,9 @@ def main():
 
     assert not args.provide_description  # not implemented
 
+    if args.suite:
+        return run_suite(args)
+
     if args.limit:
         print(
             "WARNING: --limit SHOULD ONLY BE USED FOR TESTING. REAL METRICS SHOULD NOT BE COMPUTED USING LIMIT."
@@ -84,6 +182,8 @@ def main():
         batch_size=args.batch_size,
         max_batch_size=args.max_batch_size,
         device=args.device,
+        bucket_size=args.bucket_size,
+        request_order=args.request_order,
         no_cache=args.no_cache,
         limit=args.limit,
         description_dict=description_dict,
@@ -91,24 +191,24 @@ def main():
         check_integrity=args.check_integrity,
         write_out=args.write_out,
         output_base_path=args.output_base_path,
+        write_out_compress=args.write_out_compress,
         model_prompt=args.model_prompt,
-        faireval_repeat_per_prompt=args.faireval_repeat_per_prompt
+        faireval_repeat_per_prompt=args.faireval_repeat_per_prompt,
+        run_dir=args.run_dir,
+        resume=args.resume,
+        results_db=args.results_db,
+        run_id=args.run_id,
     )
 
-    dumped = json.dumps(results, indent=2)
-    print(dumped)
-
-    if args.output_path:
-        os.makedirs(os.path.dirname(args.output_path), exist_ok=True)
-        with open(args.output_path, "w") as f:
-            f.write(dumped)
-
-    batch_sizes = ",".join(map(str, results["config"]["batch_sizes"]))
-    print(
-        f"{args.model} ({args.model_args}), limit: {args.limit}, provide_description: {args.provide_description}, "
-        f"num_fewshot: {args.num_fewshot}, batch_size: {args.batch_size}{f' ({batch_sizes})' if batch_sizes else ''}"
+    report(
+        results,
+        args.output_path,
+        args.model,
+        args.model_args,
+        args.limit,
+        args.num_fewshot,
+        args.batch_size,
     )
-    print(evaluator.make_table(results))
 
 
 if __name__ == "__main__":
@@ -3,9 +3,11 @@ import itertools
 import numpy as np
 import pandas as pd
 import datetime
+import os
 import random
 from functools import partial
 
+from lm_eval.base import hash_args
 from lm_eval.utils import positional_deprecated, run_task_tests
 import lm_eval.metrics
 import lm_eval.models
@@ -14,7 +16,13 @@ import lm_eval.base
 
 from model_prompt import MODEL_PROMPT_MAP
 from chatlm import ChatLM
+from batching import base_lm, plan_batches, prefix_sharing
+from dispatcher import TurnDispatcher
+from journal import EvalJournal
+from ledger import ResultsLedger
+from writeout import WriteOutStream
 import tasks as ta
+from tasks import bootstrap
 
 
 @positional_deprecated
@@ -34,8 +42,16 @@ def simple_evaluate(
     decontamination_ngrams_path=None,
     write_out=False,
     output_base_path=None,
+    write_out_compress=False,
     model_prompt=None,
     faireval_repeat_per_prompt=False,
+    run_dir=None,
+    resume=None,
+    results_db="results.db",
+    run_id=None,
+    lm=None,
+    bucket_size=None,
+    request_order="length",
 ):
     """Instantiate and evaluate a model on a list of tasks.
 
@@ -65,9 +81,28 @@ def simple_evaluate(
     :param check_integrity: bool
         Whether to run the relevant part of the test suite for the tasks
     :param write_out: bool
-        If True, write details about prompts and logits to json for all tasks
+        If True, write details about prompts and logits to JSONL for all tasks
     :param output_base_path: str, optional
         Directory to which detailed eval info will be written. Defaults to present working dir.
+    :param write_out_compress: bool
+        Gzip the write_out JSONL files
+    :param run_dir: str, optional
+        Directory in which the responses of this run are journaled as they return
+    :param resume: str, optional
+        Run directory of an interrupted run. Journaled responses are replayed and
+        the model is only loaded if some requests are still missing
+    :param results_db: str
+        SQLite results ledger that faireval runs append their per-prompt results to
+    :param run_id: str, optional
+        Identifier of this run in the results ledger. Defaults to a fresh unique id
+    :param lm: LM, optional
+        Already instantiated (and cached) LM to evaluate, e.g. shared by the tasks
+        of a suite. `model` and `model_args` then only describe it
+    :param bucket_size: int, optional
+        Maximal number of greedy_until requests per backend batch, requests are
+        pooled across tasks and bucketed by length. Defaults to the backend batch size
+    :param request_order: str
+        "length" or "prefix", the order in which greedy_until requests are sent, see `evaluate`
     :return
         Dictionary of results
     """
@@ -76,41 +111,37 @@ def simple_evaluate(
 
     assert len(tasks) != 0, "No tasks specified"
 
-    if isinstance(model, str):
-        if model_args is None:
-            model_args = ""
-        if model[:3] != "gpt":
-            lm = lm_eval.models.get_model(model).create_from_arg_string(
-                model_args,
-                {
-                    "batch_size": batch_size,
-                    "max_batch_size": max_batch_size,
-                    "device": device,
-                },
-            )
-        else:
-            lm = ChatLM(model)
-    else:
-        assert isinstance(model, lm_eval.base.LM)
-        lm = model
-
-    if not no_cache:
-        lm = lm_eval.base.CachingLM(
-            lm,
-            "lm_cache/"
-            + (model if isinstance(model, str) else model.model.config._name_or_path)
-            + "_"
-            + model_args.replace("=", "-").replace(",", "_").replace("/", "-")
-            + ".db",
+    if isinstance(model, str) and model_args is None:
+        model_args = ""
+
+    if lm is None:
+        lm = get_lm(
+            model,
+            model_args,
+            batch_size=batch_size,
+            max_batch_size=max_batch_size,
+            device=device,
+            no_cache=no_cache,
+            lazy=resume is not None,
         )
 
     task_dict = ta.get_task_dict(tasks)
 
+    journal = None
+    if resume is not None or run_dir is not None:
+        journal = EvalJournal(resume or run_dir, resume=resume is not None)
+
     if check_integrity:
         run_task_tests(task_list=tasks)
 
-    eval_function = partial(
-        faireval_evaluate if faireval_repeat_per_prompt else evaluate
+    model_name = model if isinstance(model, str) else model.model.config._name_or_path
+    eval_function = (
+        partial(
+            faireval_evaluate,
+            ledger=ResultsLedger(results_db, run_id=run_id, model=model_name),
+        )
+        if faireval_repeat_per_prompt
+        else evaluate
     )
 
     results = eval_function(
@@ -123,10 +154,19 @@ def simple_evaluate(
         decontamination_ngrams_path=decontamination_ngrams_path,
         write_out=write_out,
         output_base_path=output_base_path,
+        write_out_compress=write_out_compress,
         model_prompt=model_prompt,
+        journal=journal,
+        bucket_size=bucket_size,
+        request_order=request_order,
     )
 
+    if journal is not None:
+        print(f"Journal: replayed {journal.replayed} responses")
+        journal.close()
+
     # add info about the model and few shot config
+    backend = base_lm(lm)
     results["config"] = {
         "model": (
             model if isinstance(model, str) else model.model.config._name_or_path
@@ -135,22 +175,361 @@ def simple_evaluate(
         "num_fewshot": num_fewshot,
         "batch_size": batch_size,
         "batch_sizes": (
-            list(lm.batch_sizes.values()) if hasattr(lm, "batch_sizes") else []
+            list(lm.batch_sizes.values())
+            if getattr(lm, "loaded", True) and hasattr(lm, "batch_sizes")
+            else []
         ),
         "device": device,
         "no_cache": no_cache,
         "limit": limit,
         "bootstrap_iters": bootstrap_iters,
         "description_dict": description_dict,
-        "faireval_repeat_per_prompt": faireval_repeat_per_prompt
+        "faireval_repeat_per_prompt": faireval_repeat_per_prompt,
+        "run_dir": resume or run_dir,
+        "request_order": request_order,
+        "hedging": (
+            backend.hedge_stats()
+            if getattr(backend, "loaded", True) and hasattr(backend, "hedge_stats")
+            else None
+        ),
     }
 
     return results
 
 
+def build_lm(model, model_args="", batch_size=None, max_batch_size=None, device=None):
+    """Instantiate the LM named `model`, API models go through ChatLM."""
+    if model[:3] != "gpt":
+        return lm_eval.models.get_model(model).create_from_arg_string(
+            model_args,
+            {
+                "batch_size": batch_size,
+                "max_batch_size": max_batch_size,
+                "device": device,
+            },
+        )
+    return ChatLM.create_from_arg_string(model_args, {"model": model})
+
+
+def get_lm(
+    model,
+    model_args=None,
+    batch_size=None,
+    max_batch_size=None,
+    device=None,
+    no_cache=False,
+    lazy=False,
+):
+    """Instantiate the LM of `simple_evaluate`, wrapped in the request cache.
+
+    :param lazy: bool
+        Only load the model once a request actually reaches it
+    """
+    if isinstance(model, str):
+        if model_args is None:
+            model_args = ""
+
+        factory = partial(
+            build_lm,
+            model,
+            model_args,
+            batch_size=batch_size,
+            max_batch_size=max_batch_size,
+            device=device,
+        )
+        lm = LazyLM(factory) if lazy else factory()
+    else:
+        assert isinstance(model, lm_eval.base.LM)
+        lm = model
+
+    if not no_cache:
+        lm = lm_eval.base.CachingLM(
+            lm,
+            "lm_cache/"
+            + (model if isinstance(model, str) else model.model.config._name_or_path)
+            + "_"
+            + model_args.replace("=", "-").replace(",", "_").replace("/", "-")
+            + ".db",
+        )
+    return lm
+
+
+def simple_evaluate_suite(
+    entries,
+    model,
+    model_args=None,
+    batch_size=None,
+    max_batch_size=None,
+    device=None,
+    no_cache=False,
+    bucket_size=None,
+    request_order="length",
+    results_db="results.db",
+    run_id=None,
+    resume=None,
+):
+    """Evaluate one model on the tasks of a suite, loading it only once.
+
+    :param entries: list[dict]
+        Settings of each task, see `suite.load_suite`. Besides the task `name`
+        they are passed on to `simple_evaluate`, `description` as the
+        description of that task
+    :param model: str
+        Name of model, see lm_eval.models.get_model
+    :param run_id: str, optional
+        Identifier shared by the faireval results of all tasks in the ledger
+    :param resume: str, optional
+        Run directory of an interrupted suite. Every task resumes from its own
+        subdirectory, tasks without one are run from scratch
+    :return
+        Generator of (entry, results) pairs, yielded as each task finishes
+    """
+    # the model is loaded by the first request and kept for all later tasks
+    lm = get_lm(
+        model,
+        model_args,
+        batch_size=batch_size,
+        max_batch_size=max_batch_size,
+        device=device,
+        no_cache=no_cache,
+        lazy=True,
+    )
+    if run_id is None:
+        run_id = ResultsLedger.new_run_id()
+
+    for entry in entries:
+        settings = {
+            key: value
+            for key, value in entry.items()
+            if key not in ("name", "description", "output_path")
+        }
+        description_dict = (
+            {entry["name"]: entry["description"]} if "description" in entry else None
+        )
+        # every task journals in its own subdirectory of the run directory
+        if resume is not None:
+            settings.pop("run_dir", None)
+            settings["resume"] = os.path.join(resume, entry["name"])
+        elif settings.get("run_dir") is not None:
+            settings["run_dir"] = os.path.join(settings["run_dir"], entry["name"])
+        print(f"Suite: running {entry['name']}")
+        results = simple_evaluate(
+            model=model,
+            model_args=model_args,
+            tasks=[entry["name"]],
+            batch_size=batch_size,
+            max_batch_size=max_batch_size,
+            device=device,
+            no_cache=no_cache,
+            bucket_size=bucket_size,
+            request_order=request_order,
+            description_dict=description_dict,
+            results_db=results_db,
+            run_id=run_id,
+            lm=lm,
+            **settings,
+        )
+        yield entry, results
+
+
+class LazyLM:
+    """Stand-in that only builds the LM once a request actually reaches it.
+
+    Used when resuming from a journal, so that a run whose generation already
+    finished goes straight to scoring without loading the model.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lm = None
+        self._cache_hook = None
+
+    @property
+    def loaded(self):
+        return self._lm is not None
+
+    def set_cache_hook(self, cache_hook):
+        if self._lm is None:
+            self._cache_hook = cache_hook
+        else:
+            self._lm.set_cache_hook(cache_hook)
+
+    def __getattr__(self, attr):
+        if self._lm is None:
+            self._lm = self._factory()
+            if self._cache_hook is not None:
+                self._lm.set_cache_hook(self._cache_hook)
+        return getattr(self._lm, attr)
+
+
 decontaminate_suffix = "_decontaminate"
 
 
+def run_batch(
+    lm,
+    reqtype,
+    batch,
+    journal=None,
+    journal_key=None,
+    chunk_size=1000,
+    bucket_size=None,
+    order="length",
+    answer_words=None,
+    dedup_stats=None,
+):
+    """Send a dispatcher batch to the LM and return the responses in batch order.
+
+    The batch pools the requests of all tasks and prompts, which are sent in
+    buckets of similar shape (see `batching.plan_batches`) and scattered back.
+    With a journal, requests answered by an earlier run are replayed from it
+    and the rest are sent in chunks of at most `chunk_size`, each journaled as
+    soon as it returns, except with batch-file backends, which get each bucket
+    as one job. `journal_key` gives the origin key of a batch item,
+    which also names the requests of batch-file backends, and `answer_words`
+    the words that complete its answer, for streaming backends.
+
+    Identical requests, e.g. prompt templates rendering to the same context,
+    are sent once and the response is fanned out to all of them. The number
+    of requests and of requests sent of each task are counted in `dedup_stats`.
+    """
+    resps = [None] * len(batch)
+    todo = []
+    for pos, item in enumerate(batch):
+        if journal is not None:
+            done, resp = journal.lookup(journal_key(item), reqtype, item.req.args)
+            if done:
+                resps[pos] = resp
+                continue
+        todo.append(pos)
+
+    duplicates = collections.defaultdict(list)
+    for pos in todo:
+        duplicates[hash_args(reqtype, batch[pos].req.args)].append(pos)
+    unique = [positions[0] for positions in duplicates.values()]
+    hashes = dict(zip(unique, duplicates))
+    if dedup_stats is not None:
+        for positions in duplicates.values():
+            for n, pos in enumerate(positions):
+                counts = dedup_stats[batch[pos].origin[1]]
+                counts["requests"] += 1
+                counts["sent"] += n == 0
+
+    backend = base_lm(lm)
+    chunks = []
+    for bucket in plan_batches(
+        lm,
+        reqtype,
+        [batch[pos].req.args for pos in unique],
+        bucket_size=bucket_size,
+        order=order,
+    ):
+        bucket = [unique[i] for i in bucket]
+        # a batch job is journaled as a whole once it completes, chunks would
+        # only be submitted and waited for one after the other
+        step = (
+            chunk_size
+            if journal is not None and not getattr(backend, "batch", None)
+            else len(bucket)
+        )
+        chunks.extend(bucket[start : start + step] for start in range(0, len(bucket), step))
+
+    for chunk in chunks:
+        if getattr(backend, "loaded", True) and hasattr(backend, "request_origins"):
+            # lets batch-file backends name each request after its origin
+            backend.request_origins = {
+                hashes[pos]: "/".join(map(str, journal_key(batch[pos])))
+                for pos in chunk
+            }
+            backend.answer_words = {
+                hashes[pos]: answer_words(batch[pos]) if answer_words is not None else None
+                for pos in chunk
+            }
+        out = getattr(lm, reqtype)([batch[pos].req.args for pos in chunk])
+        # fan each response out to the duplicates of its request
+        answered = [
+            (dup, x) for pos, x in zip(chunk, out) for dup in duplicates[hashes[pos]]
+        ]
+        for pos, x in answered:
+            req = batch[pos].req
+            resps[pos] = x if req.index is None else x[req.index]
+        if journal is not None:
+            journal.record(
+                [
+                    (
+                        journal_key(batch[pos]),
+                        batch[pos].dialogue,
+                        reqtype,
+                        batch[pos].req.args,
+                        resps[pos],
+                    )
+                    for pos, _ in answered
+                ]
+            )
+    return resps
+
+
+def measure_prefix_sharing(requests, requests_origin):
+    """Print and return the prefix-sharing ratio of the requests of each task."""
+    task_contexts = collections.defaultdict(list)
+    for reqtype, reqs in requests.items():
+        for req, origin in zip(reqs, requests_origin[reqtype]):
+            task_contexts[origin[1]].append(req.args[0])
+
+    ratios = {}
+    for task_name, contexts in task_contexts.items():
+        ratios[task_name] = prefix_sharing(contexts)
+        print(f"Task: {task_name}; prefix sharing: {ratios[task_name]:.1%}")
+    return ratios
+
+
+def measure_dedup(dedup_stats):
+    """Print and return the fraction of the requests of each task answered by a duplicate."""
+    ratios = {}
+    for task_name, counts in dedup_stats.items():
+        ratios[task_name] = 1 - counts["sent"] / counts["requests"]
+        print(
+            f"Task: {task_name}; {counts['requests'] - counts['sent']} of "
+            f"{counts['requests']} requests deduplicated ({ratios[task_name]:.1%})"
+        )
+    return ratios
+
+
+def group_by_task(keys):
+    """Doc keys grouped by their task name, in order of first appearance."""
+    groups = collections.defaultdict(list)
+    for key in keys:
+        groups[key[0]].append(key)
+    return groups
+
+
+def sorted_responses(responses):
+    """Responses of a doc in request order, from `(request index, response)` pairs."""
+    return [resp for _, resp in sorted(responses, key=lambda x: x[0])]
+
+
+def process_results(task, docs, requests):
+    """`task.process_results` of every doc, in one call if the task can score a batch."""
+    process_results_batch = getattr(task, "process_results_batch", None)
+    if process_results_batch is not None:
+        return process_results_batch(docs, requests)
+    return [task.process_results(doc, doc_requests) for doc, doc_requests in zip(docs, requests)]
+
+
+def task_answer_words(task, doc):
+    """Words whose arrival completes an answer to `doc`, None if the task has none."""
+    answer_words = getattr(task, "answer_words", None)
+    return answer_words(doc) if answer_words is not None else None
+
+
+def write_out_truth(task, doc):
+    """Ground truth of `doc` as recorded in the write_out files."""
+    if isinstance(task, lm_eval.base.MultipleChoiceTask):
+        return doc["gold"]
+    elif isinstance(task, lm_eval.tasks.winogrande.Winogrande):
+        return task.answer_to_num[doc["answer"]]
+    return task.doc_to_target(doc)
+
+
 @positional_deprecated
 def faireval_evaluate(
     lm,
@@ -163,7 +542,12 @@ def faireval_evaluate(
     decontamination_ngrams_path=None,
     write_out=False,
     output_base_path=None,
+    write_out_compress=False,
     model_prompt=None,
+    journal=None,
+    bucket_size=None,
+    request_order="length",
+    ledger=None,
 ):
     """Instantiate and evaluate a model on a list of tasks.
 
@@ -182,9 +566,20 @@ def faireval_evaluate(
     :param description_dict: dict[str, str]
         Dictionary of custom task descriptions of the form: `task_name: description`
     :param write_out: bool
-        If True, write all prompts, logits and metrics to json for offline analysis
+        If True, stream all prompts, logits and metrics to JSONL for offline analysis
     :param output_base_path: str, optional
         Directory to which detailed eval info will be written. Defaults to present working dir
+    :param write_out_compress: bool
+        Gzip the write_out JSONL files
+    :param journal: EvalJournal, optional
+        Journal that responses are written to as they return, and replayed from when resuming
+    :param bucket_size: int, optional
+        Maximal number of greedy_until requests per backend batch. Defaults to the backend batch size
+    :param request_order: str
+        "length" to send greedy_until requests longest first, "prefix" to send them in prefix-sorted
+        order for backends with prefix caching and report how much of each task's prompts is shared
+    :param ledger: ResultsLedger, optional
+        Ledger the per-prompt results are appended to. Defaults to results.db in the working dir
     :return
         Dictionary of results
     """
@@ -208,13 +603,27 @@ def faireval_evaluate(
     versions = collections.defaultdict(dict)
 
     requests = collections.defaultdict(list)
-    turn_requests = collections.defaultdict(dict)
     requests_origin = collections.defaultdict(list)
 
     docs = {}
-    write_out_info = {}
+    # number of requests of each (task, prompt, doc), a doc is scored once all have returned
+    expected_resps = {}
+    # number of prompts of each (task, doc) left to score, the doc is dropped after the last
+    unscored_prompts = collections.Counter()
+    write_out_stream = (
+        WriteOutStream(output_base_path, compress=write_out_compress)
+        if write_out
+        else None
+    )
+    write_out_pending = collections.defaultdict(dict)
 
-    def process_task(task_name, task, limit, model_prompt, prompt_index):
+    def plan_task(task_name, task, limit):
+        """Load, shuffle and parse the docs of a task once for all its prompts.
+
+        Returns the limited doc list and the state of the few-shot generator
+        right after the shuffle, so every prompt variant renders from the same
+        permutation as if the docs had been reloaded for it.
+        """
         # default to test doc, fall back to val doc if validation unavailable
         # TODO: the test-fallback-to-val system isn't final, we should revisit it at some point
         if task.has_test_docs():
@@ -224,39 +633,40 @@ def faireval_evaluate(
         else:
             raise RuntimeError("Task has neither test_docs nor validation_docs")
 
-        # HELP
-
-        # ok the biggest issue here is trying to hijack fewshot_context so that it only uses one prompt
-        # fewshot_context uses doc_to_text so
-        # we can... ?
-
-        # honestly i think mutating might be the easiest. i.e task.set_prompt(prompt_index)
-
         # deterministically shuffle docs and chop off the first `limit` because sometimes docs are in some kind of order
-        task.set_prompt(prompt_index)
         task_docs = list(task_doc_func())
         rnd = random.Random()
         rnd.seed(42)
         rnd.shuffle(task_docs)
         print(f"Task: {task_name}; number of docs: {len(task_docs)}")
 
-        if write_out:
-            prompt_details = []
+        if limit is not None:
+            limit = int(len(task_docs) * limit) if limit < 1.0 else int(limit)
+        task_docs = list(itertools.islice(task_docs, 0, limit))
+
+        for doc_id, doc in enumerate(task_docs):
+            docs[(task_name, doc_id)] = doc
+
+        # parse the doc fields once, every prompt variant renders from these views
+        task.prepare_faireval_docs(task_docs)
+        return task_docs, rnd.getstate()
+
+    def process_task(task_name, task, task_docs, rnd_state, model_prompt, prompt_index):
+        # the few-shot generator continues from the shared shuffle, exactly as a fresh load would
+        task.set_prompt(prompt_index)
+        rnd = random.Random()
+        rnd.setstate(rnd_state)
 
         description = (
             description_dict[task_name]
             if description_dict and task_name in description_dict
             else ""
         )
-        if limit is not None:
-            limit = int(len(task_docs) * limit) if limit < 1.0 else int(limit)
 
         if model_prompt is None:
             model_prompt = "no_prompt"
 
-        for doc_id, doc in enumerate(itertools.islice(task_docs, 0, limit)):
-
-            docs[(task_name, doc_id)] = doc
+        for doc_id, doc in enumerate(task_docs):
             ctx = task.fewshot_context(
                 doc=doc, num_fewshot=num_fewshot, rnd=rnd, description=description
             )
@@ -265,9 +675,6 @@ def faireval_evaluate(
 
             reqs = task.construct_requests(doc, ctx)
 
-            if write_out:
-                prompt_details.append({"doc_id": doc_id})
-
             # print the prompt for the first few documents
             if doc_id < 1:
                 print(
@@ -277,114 +684,142 @@ def faireval_evaluate(
 
             if not isinstance(reqs, (list, tuple)):
                 reqs = [reqs]
+            expected_resps[(task_name, prompt_index, doc_id)] = len(reqs)
+            unscored_prompts[(task_name, doc_id)] += 1
             for i, req in enumerate(reqs):
                 requests[req.request_type].append(req)
                 # i: index in requests for a single task instance
                 # doc_id: unique id that we can get back to a doc using `docs`
                 diag_id = doc.get("dialogue_id", doc_id)
                 turn = doc.get("turn", 0)
-                turn_requests[(diag_id, turn)] = (task_name, doc, doc_id, req)
                 requests_origin[req.request_type].append(
                     (i, task_name, prompt_index, doc, doc_id, diag_id, turn)
                 )
 
-                # print("req: " + str(req.args))
-
-                if write_out:
-                    prompt_details[-1][f"prompt_{i}"] = "".join(
-                        (map(lambda x: "".join(x), req.args))
-                    )
-
-            # print("request:" + request[])
-        if write_out:
-            write_out_info[task_name] = prompt_details
-
     # get lists of each type of request
     for task_name, task in task_dict_items:
         versions[task_name] = task.VERSION
+        task_docs, rnd_state = plan_task(task_name, task, limit)
         for prompt_index in range(task.get_faireval_prompt_count()):
-            process_task(task_name, task, limit, model_prompt, prompt_index)
+            process_task(task_name, task, task_docs, rnd_state, model_prompt, prompt_index)
+        task.release_faireval_docs()
+        # the requests and `docs` hold the docs until they are scored
+        del task_docs
 
     # all responses for each (task, doc)
     process_res_queue = collections.defaultdict(list)
-
-    # execute each type of request
-    for reqtype, reqs in requests.items():
-        # TODO: right now, this code runs multiple separate LM requests for multiple Requests differing
-        #       only in index. We could implement some kind of caching, but that would be more of a band-aid
-        #       solution. we could also implement some kind of auto-grouping here;
-        #       they should end up next to each other.
-
-        max_turns = max([val[-1] for val in requests_origin[reqtype]])
-        print("Running", reqtype, "requests")
-        print(f"Maximum {max_turns} turns")
-        task_turns = {}
-        for cur_turn in range(max_turns + 1):
-            print(f"Running {cur_turn}th turn")
-
-            filtered_reqs = []
-
-            for req, (i, task_name, prompt_index, doc, doc_id, diag_id, turn) in zip(
-                reqs, requests_origin[reqtype]
+    vals = collections.defaultdict(list)
+    # running metric states of the tasks that fold their results, see Task.init_state
+    states = {}
+
+    def process_docs(keys):
+        """Sort the responses of the docs back in order and return control to Task.
+
+        The docs of a task with `process_results_batch` are scored in one call.
+        """
+        for task_name, task_keys in group_by_task(keys).items():
+            task = task_dict[task_name]
+            task_docs = [docs[(task_name, doc_id)] for _, _, doc_id in task_keys]
+            task_requests = [sorted_responses(process_res_queue.pop(key)) for key in task_keys]
+            for (_, prompt_index, _), doc, requests in zip(task_keys, task_docs, task_requests):
+                #prevent printing all results
+                if prompt_index == 0:
+                    print("doc: " + str(doc))
+                    print("requests: " + str(requests))
+            for key, doc, metrics in zip(
+                task_keys, task_docs, process_results(task, task_docs, task_requests)
             ):
-                if turn != cur_turn:
-                    continue
-                task_turns[task_name] = max(turn, task_turns.get(task_name, -1))
-                task = task_dict[task_name]
-                req = task.reformulate_turn_req(
-                    req,
-                    [(turn_requests.get((diag_id, t), None), t) for t in range(turn)],
-                    turn,
-                )
-                filtered_reqs.append([req, (i, task_name, prompt_index, doc, doc_id, diag_id, turn)])
-
-            resps = getattr(lm, reqtype)([req.args for req in reqs])
-            resps = [
-                x if req[0].index is None else x[req[0].index]
-                for x, req in zip(resps, filtered_reqs)
-            ]
+                process_doc(key, task, doc, metrics)
+
+    def process_doc(key, task, doc, metrics):
+        """Fold or keep the metrics of a scored doc."""
+        task_name, prompt_index, doc_id = key
+        if getattr(task, "init_state", None) is not None:
+            # the metrics of the task fold into one running state per prompt
+            if (task_name, prompt_index) not in states:
+                states[(task_name, prompt_index)] = task.init_state()
+            task.update(states[(task_name, prompt_index)], doc, metrics)
+        else:
+            for metric, value in metrics.items():
+                vals[(task_name, prompt_index, metric)].append(value)
 
-            for resp, req in zip(resps, filtered_reqs):
-                i, task_name, prompt_index, doc, doc_id, diag_id, turn = req[1]
-                task = task_dict[task_name]
-                if not task.EVAL_LAST_TURN or turn == task_turns[task_name]:
-                    process_res_queue[(task_name, prompt_index, doc_id)].append((i, resp))
-                turn_requests[(diag_id, turn)] = resp
+        if write_out:
+            write_out_stream.write(
+                task_name,
+                {
+                    "task": task_name,
+                    "prompt_index": prompt_index,
+                    "doc_id": doc_id,
+                    **write_out_pending.pop(key),
+                    "truth": write_out_truth(task, doc),
+                    **{metric: str(value) for metric, value in metrics.items()},
+                },
+            )
 
-                if write_out:
-                    write_out_info[task_name][doc_id][f"logit_{i}"] = resp
-                    task = task_dict[task_name]
-                    if isinstance(task, lm_eval.base.MultipleChoiceTask):
-                        write_out_info[task_name][doc_id]["truth"] = doc["gold"]
-                    elif isinstance(task, lm_eval.tasks.winogrande.Winogrande):
-                        write_out_info[task_name][doc_id]["truth"] = task.answer_to_num[
-                            doc["answer"]
-                        ]
-                    else:
-                        write_out_info[task_name][doc_id]["truth"] = task.doc_to_target(
-                            doc
-                        )
-    vals = collections.defaultdict(list)
+        unscored_prompts[(task_name, doc_id)] -= 1
+        if not unscored_prompts[(task_name, doc_id)]:
+            del unscored_prompts[(task_name, doc_id)]
+            del docs[(task_name, doc_id)]
 
-    # unpack results and sort back in order and return control to Task
-    for (task_name, prompt_index, doc_id), requests in process_res_queue.items():
-        requests.sort(key=lambda x: x[0])
-        requests = [x[1] for x in requests]
+    prefix_ratios = (
+        measure_prefix_sharing(requests, requests_origin)
+        if request_order == "prefix"
+        else None
+    )
 
-        task = task_dict[task_name]
-        doc = docs[(task_name, doc_id)]
+    # execute each type of request
+    dedup_stats = collections.defaultdict(collections.Counter)
+    for reqtype in list(requests):
+        # only the turns whose predecessors have returned are sent, so each request
+        # reaches the LM exactly once and later dialogue turns see earlier answers
+        dispatcher = TurnDispatcher()
+        for req, origin in zip(requests.pop(reqtype), requests_origin.pop(reqtype)):
+            i, task_name, prompt_index, doc, doc_id, diag_id, turn = origin
+            dispatcher.add(
+                task_dict[task_name], req, origin, (task_name, prompt_index, diag_id), turn
+            )
 
-        #prevent printing all results
-        if prompt_index == 0:
-            print("doc: " + str(doc))
-            print("requests: " + str(requests))
+        print("Running", reqtype, "requests")
+        print(f"Maximum {dispatcher.max_turn} turns")
+        while len(dispatcher):
+            batch = dispatcher.next_batch()
+            print(f"Running {len(batch)} requests")
+
+            resps = run_batch(
+                lm,
+                reqtype,
+                batch,
+                journal=journal,
+                bucket_size=bucket_size,
+                order=request_order,
+                journal_key=lambda item: EvalJournal.key(
+                    item.origin[1], item.origin[2], item.origin[4], item.origin[0], item.turn
+                ),
+                answer_words=lambda item: task_answer_words(
+                    task_dict[item.origin[1]], item.origin[3]
+                ),
+                dedup_stats=dedup_stats,
+            )
+            dispatcher.complete(batch, resps)
 
-        metrics = task.process_results(doc, requests)
-        for metric, value in metrics.items():
-            vals[(task_name, prompt_index, metric)].append(value)
+            # docs whose responses are all in, scored together after the batch
+            ready = []
+            for resp, item in zip(resps, batch):
+                i, task_name, prompt_index, doc, doc_id, diag_id, turn = item.origin
+                key = (task_name, prompt_index, doc_id)
+                if write_out:
+                    write_out_pending[key][f"prompt_{i}"] = "".join(
+                        (map(lambda x: "".join(x), item.req.args))
+                    )
+                    write_out_pending[key][f"logit_{i}"] = resp
+                # every turn is a doc of its own and is scored, whatever the turns
+                # of the other dialogues in the batch
+                process_res_queue[key].append((i, resp))
+                if len(process_res_queue[key]) == expected_resps[key]:
+                    ready.append(key)
+            process_docs(ready)
 
-            if write_out:
-                write_out_info[task_name][doc_id][metric] = str(value)
+    dedup_ratios = measure_dedup(dedup_stats)
 
     # aggregate results
     for (task_name, prompt_index, metric), items in vals.items():
@@ -399,7 +834,7 @@ def faireval_evaluate(
         # hotfix: bleu, chrf, ter seem to be really expensive to bootstrap
         # so we run them less iterations. still looking for a cleaner way to do this
 
-        stderr = lm_eval.metrics.stderr_for_metric(
+        stderr = bootstrap.stderr_for_metric(
             metric=task.aggregation()[real_metric],
             bootstrap_iters=(
                 min(bootstrap_iters, 1000)
@@ -411,27 +846,15 @@ def faireval_evaluate(
         if stderr is not None:
             results[task_name][metric + "_stderr"][prompt_index] = stderr(items)
 
-    if write_out:
-        import json
-        import pathlib
+    for (task_name, prompt_index), state in states.items():
+        task = task_dict[task_name]
+        for metric, (value, stderr) in task.finalize(state, bootstrap_iters).items():
+            results[task_name][metric][prompt_index] = value
+            if stderr is not None:
+                results[task_name][metric + "_stderr"][prompt_index] = stderr
 
-        output_base_path = (
-            pathlib.Path(output_base_path)
-            if output_base_path is not None
-            else pathlib.Path(".")
-        )
-        try:
-            output_base_path.mkdir(parents=True, exist_ok=False)
-        except FileExistsError:
-            pass
-
-        for task_name, _ in task_dict_items:
-            with open(
-                output_base_path.joinpath(f"{task_name}_write_out_info.json"),
-                "w",
-                encoding="utf8",
-            ) as fp:
-                json.dump(write_out_info[task_name], fp, indent=4, ensure_ascii=False)
+    if write_out:
+        write_out_stream.close()
 
     results_raw = {
         task_name: {
@@ -457,25 +880,27 @@ def faireval_evaluate(
     #     orient = 'index'
     # )
     df_results['time'] = datetime.datetime.now()
-    
-    try:
-        results_record = pd.read_csv('results.csv')
-        results_record = pd.concat([results_record, df_results])
-    except:
-        results_record = df_results
 
-    results_record.to_csv('results.csv', index = False)
+    # only this run's rows are appended, concurrent runs keep each other's rows
+    if ledger is None:
+        ledger = ResultsLedger()
+    ledger.append(df_results)
 
 
 
+    # the bootstrap stderrs of each prompt are averaged, their spread over prompts is not reported
     results_processed = {
         task_name: {
             **{metric + "_mean": np.mean(list(results[task_name][metric].values())) for metric in metrics},
-            **{metric + "_prompt_stderr": np.std(list(results[task_name][metric].values()), ddof = 1) for metric in metrics}
+            **{metric + "_prompt_stderr": np.std(list(results[task_name][metric].values()), ddof = 1) for metric in metrics if not metric.endswith("_stderr")}
         } for task_name, metrics in results.items()
     }
 
-    return {"results": dict(results_processed), "versions": dict(versions)}
+    output = {"results": dict(results_processed), "versions": dict(versions)}
+    output["dedup"] = dedup_ratios
+    if prefix_ratios is not None:
+        output["prefix_sharing"] = prefix_ratios
+    return output
 
 
 @positional_deprecated
@@ -490,7 +915,11 @@ def evaluate(
     decontamination_ngrams_path=None,
     write_out=False,
     output_base_path=None,
+    write_out_compress=False,
     model_prompt=None,
+    journal=None,
+    bucket_size=None,
+    request_order="length",
 ):
     """Instantiate and evaluate a model on a list of tasks.
 
@@ -509,9 +938,18 @@ def evaluate(
     :param description_dict: dict[str, str]
         Dictionary of custom task descriptions of the form: `task_name: description`
     :param write_out: bool
-        If True, write all prompts, logits and metrics to json for offline analysis
+        If True, stream all prompts, logits and metrics to JSONL for offline analysis
     :param output_base_path: str, optional
         Directory to which detailed eval info will be written. Defaults to present working dir
+    :param write_out_compress: bool
+        Gzip the write_out JSONL files
+    :param journal: EvalJournal, optional
+        Journal that responses are written to as they return, and replayed from when resuming
+    :param bucket_size: int, optional
+        Maximal number of greedy_until requests per backend batch. Defaults to the backend batch size
+    :param request_order: str
+        "length" to send greedy_until requests longest first, "prefix" to send them in prefix-sorted
+        order for backends with prefix caching and report how much of each task's prompts is shared
     :return
         Dictionary of results
     """
@@ -537,7 +975,6 @@ def evaluate(
     versions = collections.defaultdict(dict)
 
     requests = collections.defaultdict(list)
-    turn_requests = collections.defaultdict(dict)
     requests_origin = collections.defaultdict(list)
 
     overlaps = collections.defaultdict(list)  # {task_name: contaminated_docs}
@@ -549,7 +986,14 @@ def evaluate(
 
     # TODO: we need unit tests & sanity checks or something to ensure that the return of `validation_docs` is stable
     docs = {}
-    write_out_info = {}
+    # number of requests of each (task, doc), a doc is scored once all have returned
+    expected_resps = {}
+    write_out_stream = (
+        WriteOutStream(output_base_path, compress=write_out_compress)
+        if write_out
+        else None
+    )
+    write_out_pending = collections.defaultdict(dict)
 
     docs_for_decontamination = collections.defaultdict(list)
 
@@ -574,9 +1018,6 @@ def evaluate(
         rnd.shuffle(task_docs)
         print(f"Task: {task_name}; number of docs: {len(task_docs)}")
 
-        if write_out:
-            prompt_details = []
-
         description = (
             description_dict[task_name]
             if description_dict and task_name in description_dict
@@ -603,9 +1044,6 @@ def evaluate(
 
             reqs = task.construct_requests(doc, ctx)
 
-            if write_out:
-                prompt_details.append({"doc_id": doc_id})
-
             # print the prompt for the first few documents
             if doc_id < 1:
                 print(
@@ -615,27 +1053,23 @@ def evaluate(
 
             if not isinstance(reqs, (list, tuple)):
                 reqs = [reqs]
+            expected_resps[(task_name, doc_id)] = len(reqs)
             for i, req in enumerate(reqs):
                 requests[req.request_type].append(req)
                 # i: index in requests for a single task instance
                 # doc_id: unique id that we can get back to a doc using `docs`
                 diag_id = doc.get("dialogue_id", doc_id)
                 turn = doc.get("turn", 0)
-                turn_requests[(diag_id, turn)] = (task_name, doc, doc_id, req)
                 requests_origin[req.request_type].append(
                     (i, task_name, doc, doc_id, diag_id, turn)
                 )
 
                 # print("req: " + str(req.args))
 
-                if write_out:
-                    prompt_details[-1][f"prompt_{i}"] = "".join(
-                        (map(lambda x: "".join(x), req.args))
-                    )
-
             # print("request:" + request[])
-        if write_out:
-            write_out_info[task_name] = prompt_details
+
+        # the requests and `docs` hold the docs until they are scored
+        del task_docs
 
     # Compare all tasks/sets at once to ensure a single training set scan
     if decontaminate:
@@ -648,86 +1082,122 @@ def evaluate(
 
     # all responses for each (task, doc)
     process_res_queue = collections.defaultdict(list)
-
-    # execute each type of request
-    for reqtype, reqs in requests.items():
-        # TODO: right now, this code runs multiple separate LM requests for multiple Requests differing
-        #       only in index. We could implement some kind of caching, but that would be more of a band-aid
-        #       solution. we could also implement some kind of auto-grouping here;
-        #       they should end up next to each other.
-
-        max_turns = max([val[-1] for val in requests_origin[reqtype]])
-        print("Running", reqtype, "requests")
-        print(f"Maximum {max_turns} turns")
-        task_turns = {}
-        for cur_turn in range(max_turns + 1):
-            print(f"Running {cur_turn}th turn")
-
-            filtered_reqs = []
-
-            for req, (i, task_name, doc, doc_id, diag_id, turn) in zip(
-                reqs, requests_origin[reqtype]
+    vals = collections.defaultdict(list)
+    # running metric states of the tasks that fold their results, see Task.init_state
+    states = {}
+
+    def process_docs(keys):
+        """Sort the responses of the docs back in order and return control to Task.
+
+        The docs of a task with `process_results_batch` are scored in one call.
+        """
+        for task_name, task_keys in group_by_task(keys).items():
+            task = task_dict[task_name]
+            task_docs = [docs[key] for key in task_keys]
+            task_requests = [sorted_responses(process_res_queue.pop(key)) for key in task_keys]
+            for doc, requests in zip(task_docs, task_requests):
+                print("doc: " + str(doc))
+                print("requests: " + str(requests))
+            for key, doc, metrics in zip(
+                task_keys, task_docs, process_results(task, task_docs, task_requests)
             ):
-                if turn != cur_turn:
-                    continue
-                task_turns[task_name] = max(turn, task_turns.get(task_name, -1))
-                task = task_dict[task_name]
-                req = task.reformulate_turn_req(
-                    req,
-                    [(turn_requests.get((diag_id, t), None), t) for t in range(turn)],
-                    turn,
-                )
-                filtered_reqs.append([req, (i, task_name, doc, doc_id, diag_id, turn)])
+                process_doc(key, task, doc, metrics)
+
+    def process_doc(key, task, doc, metrics):
+        """Fold or keep the metrics of a scored doc."""
+        task_name, doc_id = key
+        if getattr(task, "init_state", None) is not None:
+            # the metrics of the task fold into one running state, and one more
+            # for the decontaminated set
+            suffixes = [""]
+            if decontaminate and task_name in overlaps:
+                if doc_id not in overlaps[task_name]:
+                    suffixes.append(decontaminate_suffix)
+            for suffix in suffixes:
+                if (task_name, suffix) not in states:
+                    states[(task_name, suffix)] = task.init_state()
+                task.update(states[(task_name, suffix)], doc, metrics)
+        else:
+            for metric, value in metrics.items():
+                vals[(task_name, metric)].append(value)
 
-            resps = getattr(lm, reqtype)([req.args for req in reqs])
-            resps = [
-                x if req[0].index is None else x[req[0].index]
-                for x, req in zip(resps, filtered_reqs)
-            ]
+                # Re-use the evaluation for the decontaminated set by just ignoring the overlaps
+                if decontaminate and task_name in overlaps:
+                    if doc_id not in overlaps[task_name]:
+                        vals[(task_name, metric + decontaminate_suffix)].append(value)
 
-            for resp, req in zip(resps, filtered_reqs):
-                i, task_name, doc, doc_id, diag_id, turn = req[1]
-                task = task_dict[task_name]
-                if not task.EVAL_LAST_TURN or turn == task_turns[task_name]:
-                    process_res_queue[(task_name, doc_id)].append((i, resp))
-                turn_requests[(diag_id, turn)] = resp
+        if write_out:
+            write_out_stream.write(
+                task_name,
+                {
+                    "task": task_name,
+                    "doc_id": doc_id,
+                    **write_out_pending.pop(key),
+                    "truth": write_out_truth(task, doc),
+                    **{metric: str(value) for metric, value in metrics.items()},
+                },
+            )
 
-                if write_out:
-                    write_out_info[task_name][doc_id][f"logit_{i}"] = resp
-                    task = task_dict[task_name]
-                    if isinstance(task, lm_eval.base.MultipleChoiceTask):
-                        write_out_info[task_name][doc_id]["truth"] = doc["gold"]
-                    elif isinstance(task, lm_eval.tasks.winogrande.Winogrande):
-                        write_out_info[task_name][doc_id]["truth"] = task.answer_to_num[
-                            doc["answer"]
-                        ]
-                    else:
-                        write_out_info[task_name][doc_id]["truth"] = task.doc_to_target(
-                            doc
-                        )
-    vals = collections.defaultdict(list)
+        # a doc is scored once, its metrics hold all that is left of it
+        del docs[key]
 
-    # unpack results and sort back in order and return control to Task
-    for (task_name, doc_id), requests in process_res_queue.items():
-        requests.sort(key=lambda x: x[0])
-        requests = [x[1] for x in requests]
+    prefix_ratios = (
+        measure_prefix_sharing(requests, requests_origin)
+        if request_order == "prefix"
+        else None
+    )
 
-        task = task_dict[task_name]
-        doc = docs[(task_name, doc_id)]
-        print("doc: " + str(doc))
-        print("requests: " + str(requests))
+    # execute each type of request
+    dedup_stats = collections.defaultdict(collections.Counter)
+    for reqtype in list(requests):
+        # only the turns whose predecessors have returned are sent, so each request
+        # reaches the LM exactly once and later dialogue turns see earlier answers
+        dispatcher = TurnDispatcher()
+        for req, origin in zip(requests.pop(reqtype), requests_origin.pop(reqtype)):
+            i, task_name, doc, doc_id, diag_id, turn = origin
+            dispatcher.add(task_dict[task_name], req, origin, (task_name, diag_id), turn)
 
-        metrics = task.process_results(doc, requests)
-        for metric, value in metrics.items():
-            vals[(task_name, metric)].append(value)
+        print("Running", reqtype, "requests")
+        print(f"Maximum {dispatcher.max_turn} turns")
+        while len(dispatcher):
+            batch = dispatcher.next_batch()
+            print(f"Running {len(batch)} requests")
+
+            resps = run_batch(
+                lm,
+                reqtype,
+                batch,
+                journal=journal,
+                bucket_size=bucket_size,
+                order=request_order,
+                journal_key=lambda item: EvalJournal.key(
+                    item.origin[1], None, item.origin[3], item.origin[0], item.turn
+                ),
+                answer_words=lambda item: task_answer_words(
+                    task_dict[item.origin[1]], item.origin[2]
+                ),
+                dedup_stats=dedup_stats,
+            )
+            dispatcher.complete(batch, resps)
 
-            if write_out:
-                write_out_info[task_name][doc_id][metric] = str(value)
+            # docs whose responses are all in, scored together after the batch
+            ready = []
+            for resp, item in zip(resps, batch):
+                i, task_name, doc, doc_id, diag_id, turn = item.origin
+                key = (task_name, doc_id)
+                if write_out:
+                    write_out_pending[key][f"prompt_{i}"] = "".join(
+                        (map(lambda x: "".join(x), item.req.args))
+                    )
+                    write_out_pending[key][f"logit_{i}"] = resp
+                # every turn is a doc of its own and is scored, whatever the turns
+                # of the other dialogues in the batch
+                process_res_queue[key].append((i, resp))
+                if len(process_res_queue[key]) == expected_resps[key]:
+                    ready.append(key)
+            process_docs(ready)
 
-            # Re-use the evaluation for the decontaminated set by just ignoring the overlaps
-            if decontaminate and task_name in overlaps:
-                if doc_id not in overlaps[task_name]:
-                    vals[(task_name, metric + decontaminate_suffix)].append(value)
+    dedup_ratios = measure_dedup(dedup_stats)
 
     # aggregate results
     for (task_name, metric), items in vals.items():
@@ -742,7 +1212,7 @@ def evaluate(
         # hotfix: bleu, chrf, ter seem to be really expensive to bootstrap
         # so we run them less iterations. still looking for a cleaner way to do this
 
-        stderr = lm_eval.metrics.stderr_for_metric(
+        stderr = bootstrap.stderr_for_metric(
             metric=task.aggregation()[real_metric],
             bootstrap_iters=(
                 min(bootstrap_iters, 1000)
@@ -754,29 +1224,21 @@ def evaluate(
         if stderr is not None:
             results[task_name][metric + "_stderr"] = stderr(items)
 
-    if write_out:
-        import json
-        import pathlib
-
-        output_base_path = (
-            pathlib.Path(output_base_path)
-            if output_base_path is not None
-            else pathlib.Path(".")
-        )
-        try:
-            output_base_path.mkdir(parents=True, exist_ok=False)
-        except FileExistsError:
-            pass
+    for (task_name, suffix), state in states.items():
+        task = task_dict[task_name]
+        for metric, (value, stderr) in task.finalize(state, bootstrap_iters).items():
+            results[task_name][metric + suffix] = value
+            if stderr is not None:
+                results[task_name][metric + suffix + "_stderr"] = stderr
 
-        for task_name, _ in task_dict_items:
-            with open(
-                output_base_path.joinpath(f"{task_name}_write_out_info.json"),
-                "w",
-                encoding="utf8",
-            ) as fp:
-                json.dump(write_out_info[task_name], fp, indent=4, ensure_ascii=False)
+    if write_out:
+        write_out_stream.close()
 
-    return {"results": dict(results), "versions": dict(versions)}
+    output = {"results": dict(results), "versions": dict(versions)}
+    output["dedup"] = dedup_ratios
+    if prefix_ratios is not None:
+        output["prefix_sharing"] = prefix_ratios
+    return output
 
 
 def make_table(result_dict):
@@ -793,11 +1255,13 @@ def make_table(result_dict):
     for k, dic in result_dict["results"].items():
         version = result_dict["versions"][k]
         for m, v in dic.items():
-            if m.endswith("_stderr"):
+            if m.endswith(("_stderr", "_stderr_mean")):
                 continue
 
-            if m + "_stderr" in dic:
-                se = dic[m + "_stderr"]
+            # faireval reports the mean over prompts of the metric and of its bootstrap stderr
+            se_key = m[: -len("_mean")] + "_stderr_mean" if m.endswith("_mean") else m + "_stderr"
+            if se_key in dic:
+                se = dic[se_key]
                 values.append([k, version, m, "%.4f" % v, "±", "%.4f" % se])
             else:
                 values.append([k, version, m, "%.4f" % v, "", ""])
@@ -0,0 +1,103 @@
+import json
+import os
+import pathlib
+
+from lm_eval.base import hash_args
+
+
+class EvalJournal:
+    """Append-only on-disk record of the responses of an evaluation run.
+
+    Every response is written as one JSON line keyed by task, prompt_index,
+    doc_id, request index and turn, together with a hash of the request so a
+    resumed run only replays responses to identical requests. Lines are
+    flushed and synced as batches return, so a crash during generation or
+    aggregation loses at most the batch in flight.
+
+    Unlike `lm_eval.base.CachingLM` this works under `--no_cache` and keeps the
+    dialogue/turn structure that multi-turn tasks need to be replayed.
+    """
+
+    FILENAME = "journal.jsonl"
+
+    def __init__(self, run_dir, resume=False):
+        """
+
+        :param run_dir: str
+            Directory of the run, created if missing
+        :param resume: bool
+            Load the responses already journaled in `run_dir`
+        """
+        self.run_dir = pathlib.Path(run_dir)
+        self.run_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.run_dir.joinpath(self.FILENAME)
+        self.entries = {}
+        self.replayed = 0
+        if resume:
+            self.load()
+        elif self.path.exists():
+            raise FileExistsError(
+                f"{self.path} already exists, pass it to --resume to continue that run"
+            )
+        self.fp = open(self.path, "a", encoding="utf8")
+
+    @staticmethod
+    def key(task_name, prompt_index, doc_id, i, turn):
+        return (task_name, prompt_index, doc_id, i, turn)
+
+    def load(self):
+        if not self.path.exists():
+            return
+        with open(self.path, "rb+") as fp:
+            data = fp.read()
+            # cut a torn last line from a crash mid-write, so that the records
+            # appended by this run start on a line of their own
+            complete = data.rfind(b"\n") + 1
+            if complete < len(data):
+                fp.truncate(complete)
+        for line in data[:complete].decode("utf8").split("\n"):
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            key = self.key(
+                record["task"],
+                record["prompt_index"],
+                record["doc_id"],
+                record["i"],
+                record["turn"],
+            )
+            self.entries[key] = (record["hash"], record["resp"])
+        print(f"Journal: loaded {len(self.entries)} responses from {self.path}")
+
+    def lookup(self, key, reqtype, args):
+        """Return `(True, response)` if the request was already answered."""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != hash_args(reqtype, args):
+            return False, None
+        self.replayed += 1
+        return True, entry[1]
+
+    def record(self, items):
+        """Append `(key, dialogue, reqtype, args, response)` tuples and sync them to disk."""
+        for key, dialogue, reqtype, args, resp in items:
+            task_name, prompt_index, doc_id, i, turn = key
+            record = {
+                "task": task_name,
+                "prompt_index": prompt_index,
+                "doc_id": doc_id,
+                "i": i,
+                "turn": turn,
+                "dialogue": dialogue,
+                "reqtype": reqtype,
+                "hash": hash_args(reqtype, args),
+                "resp": resp,
+            }
+            self.fp.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def close(self):
+        self.fp.close()
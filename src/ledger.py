@@ -0,0 +1,111 @@
+import contextlib
+import datetime
+import sqlite3
+import uuid
+
+import pandas as pd
+
+
+class ResultsLedger:
+    """Append-only SQLite ledger of per-prompt faireval results.
+
+    Replaces the results.csv that was read and rewritten in full after every
+    run. Each run only inserts its own rows, and the database runs in WAL mode
+    with a busy timeout, so concurrent runs can append to the same ledger
+    without losing each other's rows.
+    """
+
+    COLUMNS = ["run_id", "model", "task_name", "metric", "trial", "value", "time"]
+
+    def __init__(self, path="results.db", run_id=None, model=None):
+        """
+
+        :param path: str
+            Path of the SQLite database, created if missing
+        :param run_id: str, optional
+            Identifier of the run appending rows. Defaults to a fresh unique id
+        :param model: str, optional
+            Name of the evaluated model, stored with every row. Stored as ""
+            if not given
+        """
+        self.path = path
+        self.run_id = run_id or self.new_run_id()
+        # part of the primary key, where SQLite would keep NULLs distinct
+        self.model = model or ""
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "run_id TEXT NOT NULL, model TEXT NOT NULL DEFAULT '', task_name TEXT NOT NULL, "
+                "metric TEXT NOT NULL, trial INTEGER NOT NULL, value REAL, time TEXT, "
+                "PRIMARY KEY (run_id, model, task_name, metric, trial))"
+            )
+
+    @staticmethod
+    def new_run_id():
+        return "{}-{}".format(
+            datetime.datetime.now().strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8]
+        )
+
+    @contextlib.contextmanager
+    def connect(self):
+        """Open a connection whose statements commit together, then close it."""
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def append(self, df_results):
+        """Insert the rows of a task_name/metric/value/trial/time DataFrame for this run."""
+        rows = [
+            (
+                self.run_id,
+                self.model,
+                row.task_name,
+                row.metric,
+                int(row.trial),
+                None if pd.isna(row.value) else float(row.value),
+                str(row.time),
+            )
+            for row in df_results.itertuples(index=False)
+        ]
+        with self.connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+        return len(rows)
+
+    def query(self, run_id=None, model=None, task_name=None, metric=None):
+        """Return the matching rows as the DataFrame previously read from results.csv.
+
+        The columns are task_name, metric, value, trial and time, followed by
+        run_id and model.
+        """
+        filters = {
+            "run_id": run_id,
+            "model": model,
+            "task_name": task_name,
+            "metric": metric,
+        }
+        clauses = [f"{column} = ?" for column, value in filters.items() if value is not None]
+        params = [value for value in filters.values() if value is not None]
+        sql = "SELECT * FROM results"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY time, run_id, task_name, metric, trial"
+
+        with self.connect() as conn:
+            df = pd.read_sql_query(sql, conn, params=params)
+        df["time"] = pd.to_datetime(df["time"])
+        return df[["task_name", "metric", "value", "trial", "time", "run_id", "model"]]
+
+    def import_csv(self, path):
+        """Append the rows of a legacy results.csv, one run per recorded time."""
+        df = pd.read_csv(path)
+        imported = 0
+        for time, rows in df.groupby("time"):
+            ledger = ResultsLedger(self.path, run_id=f"csv-{time}", model=self.model)
+            imported += ledger.append(rows)
+        return imported
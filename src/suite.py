@@ -0,0 +1,81 @@
+import json
+
+# settings of the model, shared by every task of the suite
+MODEL_KEYS = [
+    "model",
+    "model_args",
+    "batch_size",
+    "max_batch_size",
+    "device",
+    "no_cache",
+    "bucket_size",
+    "request_order",
+]
+# settings that each task can override, given at the top level they are the defaults
+TASK_KEYS = [
+    "num_fewshot",
+    "limit",
+    "model_prompt",
+    "description",
+    "bootstrap_iters",
+    "faireval_repeat_per_prompt",
+    "write_out",
+    "output_base_path",
+    "write_out_compress",
+    "output_path",
+    "run_dir",
+]
+
+
+def load_suite(path):
+    """Load a YAML or JSON suite file.
+
+    A suite names the model once and lists the tasks to run with it:
+
+        model: hf-causal-vllm
+        model_args: pretrained=meta-llama/Llama-2-7b-chat-hf,use_fast=False
+        batch_size: 256
+        no_cache: true
+        faireval_repeat_per_prompt: true
+        num_fewshot: 0
+        tasks:
+          - faireval_fpb
+          - name: faireval_ner
+            num_fewshot: 3
+            limit: 0.5
+            output_path: results/faireval_ner.json
+
+    Top-level task settings (`TASK_KEYS`) are the defaults of every task, and
+    a task given as a mapping can override them.
+
+    :return: (dict, list[dict])
+        The model settings, and the settings of every task with its `name`
+    """
+    with open(path, "r", encoding="utf8") as f:
+        if str(path).endswith((".yaml", ".yml")):
+            import yaml
+
+            suite = yaml.safe_load(f)
+        else:
+            suite = json.load(f)
+
+    unknown = set(suite) - set(MODEL_KEYS) - set(TASK_KEYS) - {"tasks"}
+    if unknown:
+        raise ValueError(f"Unknown suite settings: {sorted(unknown)}")
+    if not suite.get("tasks"):
+        raise ValueError(f"Suite {path} lists no tasks")
+
+    model_settings = {key: suite[key] for key in MODEL_KEYS if key in suite}
+    defaults = {key: suite[key] for key in TASK_KEYS if key in suite}
+
+    entries = []
+    for task in suite["tasks"]:
+        if isinstance(task, str):
+            task = {"name": task}
+        unknown = set(task) - set(TASK_KEYS) - {"name"}
+        if "name" not in task or unknown:
+            raise ValueError(
+                f"Suite task {task} needs a name and only accepts {TASK_KEYS}"
+            )
+        entries.append({**defaults, **task})
+    return model_settings, entries
@@ -63,6 +63,15 @@ TASK_REGISTRY = {
     **flare.SM_TASKS,
 }
 
+# every classification task can also be scored by ranking its choices, as `<task>_choice`
+TASK_REGISTRY.update(
+    {
+        f"{task_name}_choice": flare.choice_scoring(task_class)
+        for task_name, task_class in TASK_REGISTRY.items()
+        if issubclass(task_class, flare.Classification)
+    }
+)
+
 ALL_TASKS = sorted(list(TASK_REGISTRY))
 
 _EXAMPLE_JSON_PATH = "split:key:/absolute/path/to/data.json"
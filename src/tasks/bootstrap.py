@@ -0,0 +1,350 @@
+"""
+Bootstrap standard errors for the FLARE metrics.
+
+Classification metrics only depend on how many items fall in each
+(prediction, gold) cell, so resampling n items with replacement is the same
+as drawing the cell counts from a multinomial. The engine below encodes the
+items once and evaluates every resample at once from the per-resample
+confusion matrices, instead of calling sklearn once per resample.
+
+Metrics that cannot be written as confusion-matrix arithmetic (ROUGE, ...)
+are bootstrapped on a process pool instead, and those that only depend on
+summed per-item counts (entity F1) from the resampled sums.
+"""
+
+import atexit
+import math
+import multiprocessing as mp
+import os
+import pickle
+import random
+import warnings
+from multiprocessing import shared_memory
+
+import numpy as np
+import lm_eval.metrics
+
+BOOTSTRAP_SEED = 1234
+# resamples evaluated per vectorised chunk, bounds memory to CHUNK x cells
+CHUNK_SIZE = 10000
+# the parallel bootstrap always splits the resamples into this many seeded
+# slices, so its result does not depend on the number of workers
+PARALLEL_SLICES = 64
+
+
+def vectorised(stat):
+    """Register an items -> value metric as the confusion statistic `stat`.
+
+    `stat` is one of the keys of `CONFUSION_STATS`; the metric must compute the
+    same value as that statistic on its (pred, gold) items.
+    """
+
+    def decorator(fn):
+        fn.vectorised_stat = stat
+        return fn
+
+    return decorator
+
+
+def parallel(fn):
+    """Register an items -> value metric for the process-pool bootstrap."""
+    fn.parallel_bootstrap = True
+    return fn
+
+
+def encode_pairs(items):
+    """Encode (pred, gold) items as counts over the observed cells.
+
+    :return: (pred_codes, gold_codes, counts, n_values)
+        Integer codes of the pred and gold of every observed cell, how many
+        items fall in it, and the number of distinct label values.
+    """
+    values = {}
+    cells = {}
+    for pred, gold in items:
+        cell = (values.setdefault(pred, len(values)), values.setdefault(gold, len(values)))
+        cells[cell] = cells.get(cell, 0) + 1
+    codes = np.array(list(cells), dtype=np.int64).reshape(-1, 2)
+    counts = np.array(list(cells.values()), dtype=np.int64)
+    return codes[:, 0], codes[:, 1], counts, len(values)
+
+
+def _cell_totals(pred_codes, gold_codes, counts, n_values):
+    """Per-label support, predicted count and true positives of each resample.
+
+    :param counts: np.ndarray
+        (resamples, cells) matrix of cell counts
+    """
+    n_cells = len(pred_codes)
+    rows = np.arange(n_cells)
+    gold_onehot = np.zeros((n_cells, n_values))
+    gold_onehot[rows, gold_codes] = 1
+    pred_onehot = np.zeros((n_cells, n_values))
+    pred_onehot[rows, pred_codes] = 1
+    diag_onehot = gold_onehot * (pred_codes == gold_codes)[:, None]
+    counts = counts.astype(np.float64)
+    return counts @ gold_onehot, counts @ pred_onehot, counts @ diag_onehot
+
+
+def _label_f1(support, pred_count, tp):
+    # labels are the golds present in the resample, so support > 0 for all of them
+    present = support > 0
+    denom = np.where(present, support + pred_count, 1.0)
+    return np.where(present, 2 * tp / denom, 0.0), present
+
+
+def weighted_f1_stat(support, pred_count, tp):
+    """sklearn f1_score(average="weighted", labels=set(golds)) per resample."""
+    f1, _ = _label_f1(support, pred_count, tp)
+    return (f1 * support).sum(axis=1) / support.sum(axis=1)
+
+
+def macro_f1_stat(support, pred_count, tp):
+    """sklearn f1_score(average="macro", labels=set(golds)) per resample."""
+    f1, present = _label_f1(support, pred_count, tp)
+    return f1.sum(axis=1) / present.sum(axis=1)
+
+
+def mcc_stat(support, pred_count, tp):
+    """Classification.matthews_corrcoef per resample.
+
+    Predictions outside the golds of the resample share the -1 class.
+    """
+    present = support > 0
+    n = support.sum(axis=1)
+    pred_present = pred_count * present
+    pred_other = n - pred_present.sum(axis=1)
+    cov_ytyp = tp.sum(axis=1) * n - (support * pred_present).sum(axis=1)
+    cov_ypyp = n**2 - (pred_present**2).sum(axis=1) - pred_other**2
+    cov_ytyt = n**2 - (support**2).sum(axis=1)
+    denom = cov_ypyp * cov_ytyt
+    safe = np.where(denom == 0, 1.0, denom)
+    return np.where(denom == 0, 0.0, cov_ytyp / np.sqrt(safe))
+
+
+CONFUSION_STATS = {
+    "weighted_f1": weighted_f1_stat,
+    "macro_f1": macro_f1_stat,
+    "mcc": mcc_stat,
+}
+
+
+def confusion_stat(stat, pred_codes, gold_codes, counts, n_values):
+    """Evaluate `stat` on every row of a (resamples, cells) count matrix."""
+    totals = _cell_totals(pred_codes, gold_codes, np.atleast_2d(counts), n_values)
+    return CONFUSION_STATS[stat](*totals)
+
+
+def confusion_bootstrap_stderr(stat, pred_codes, gold_codes, counts, n_values, iters):
+    """Bootstrap stderr of `stat` from multinomial resamples of the cell counts."""
+    rng = np.random.default_rng(BOOTSTRAP_SEED)
+    n = counts.sum()
+    probs = counts / n
+    res = []
+    for start in range(0, iters, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, iters - start)
+        resampled = rng.multinomial(n, probs, size=size)
+        res.append(confusion_stat(stat, pred_codes, gold_codes, resampled, n_values))
+    res = np.concatenate(res)
+    return float(np.std(res, ddof=1))
+
+
+def binary_mean_stderr(ones, n):
+    """`lm_eval.metrics.mean_stderr` of `ones` 1s among `n` 0/1 values, in closed form."""
+    mu = ones / n
+    return math.sqrt((ones * (1 - mu) ** 2 + (n - ones) * mu**2) / (n - 1)) / math.sqrt(n)
+
+
+class ConfusionMatrix:
+    """Running (pred, gold) cell counts of a classification task.
+
+    Labels and cells are coded in order of first appearance, as `encode_pairs`
+    codes a list of items, so every statistic and bootstrap equals that of
+    the items the matrix was fed, in O(labels^2) memory instead of O(items).
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.cells = {}
+        self.n = 0
+
+    def add(self, pred, gold):
+        values = self.values
+        cell = (values.setdefault(pred, len(values)), values.setdefault(gold, len(values)))
+        self.cells[cell] = self.cells.get(cell, 0) + 1
+        self.n += 1
+
+    def encoded(self):
+        """The matrix as the `encode_pairs` of its items."""
+        codes = np.array(list(self.cells), dtype=np.int64).reshape(-1, 2)
+        counts = np.array(list(self.cells.values()), dtype=np.int64)
+        return codes[:, 0], codes[:, 1], counts, len(self.values)
+
+    def correct(self):
+        """Number of items whose pred is their gold."""
+        return sum(count for (pred, gold), count in self.cells.items() if pred == gold)
+
+    def predicted(self, label):
+        """Number of items predicted as `label`."""
+        code = self.values.get(label)
+        return sum(count for (pred, _), count in self.cells.items() if pred == code)
+
+    def stat(self, stat):
+        """Value of the confusion statistic `stat`, see `CONFUSION_STATS`."""
+        return float(confusion_stat(stat, *self.encoded())[0])
+
+    def stderr(self, stat, iters):
+        """Bootstrap stderr of the confusion statistic `stat`."""
+        return confusion_bootstrap_stderr(stat, *self.encoded(), iters=iters)
+
+
+class EmptyResample(ValueError):
+    """Raised by a metric on a resample that holds nothing it can score.
+
+    The parallel bootstrap skips such resamples, e.g. TSA resamples whose
+    predictions are all missing. Any other error of the metric is raised.
+    """
+
+
+# metric and items of the running parallel bootstrap in a worker, loaded once
+# per bootstrap from the shared memory block named "name"
+_WORKER_STATE = {}
+# process pools of the parallel bootstrap by number of workers, shared by all
+# metrics of the run
+_POOLS = {}
+
+
+def _bootstrap_pool(workers):
+    """The pool of `workers` processes, started on first use and kept for the run.
+
+    Workers are started by a forkserver (or spawned where there is none),
+    never forked from this process, which may already hold a model and its
+    CUDA context by the time the metrics are computed.
+    """
+    pool = _POOLS.get(workers)
+    if pool is None:
+        methods = mp.get_all_start_methods()
+        ctx = mp.get_context("forkserver" if "forkserver" in methods else "spawn")
+        pool = _POOLS[workers] = ctx.Pool(workers)
+    return pool
+
+
+@atexit.register
+def _close_pools():
+    while _POOLS:
+        _, pool = _POOLS.popitem()
+        pool.close()
+        pool.join()
+
+
+def _load_payload(name, size):
+    if _WORKER_STATE.get("name") != name:
+        block = shared_memory.SharedMemory(name=name)
+        try:
+            metric, items = pickle.loads(block.buf[:size])
+        finally:
+            block.close()
+        _WORKER_STATE.update(name=name, metric=metric, items=items)
+    return _WORKER_STATE["metric"], _WORKER_STATE["items"]
+
+
+def _bootstrap_slice(args):
+    name, size, slice_index, resamples = args
+    metric, items = _load_payload(name, size)
+    rnd = random.Random(BOOTSTRAP_SEED + slice_index)
+    values = []
+    skipped = 0
+    for _ in range(resamples):
+        resample = rnd.choices(items, k=len(items))
+        try:
+            values.append(metric(resample))
+        except EmptyResample:
+            skipped += 1
+    return values, skipped
+
+
+def parallel_bootstrap_stderr(metric, items, iters, workers=None):
+    """Bootstrap stderr of `metric` with the resamples spread over a process pool.
+
+    The metric and items are pickled once into shared memory, which every
+    worker reads once. Each slice of resamples has its own seed, so the
+    result is reproducible for any number of workers.
+
+    Resamples on which the metric raises `EmptyResample` are skipped with a
+    warning, and the stderr is NaN if fewer than two resamples could be scored.
+    """
+    slice_size = math.ceil(iters / PARALLEL_SLICES)
+    slices = [
+        (i, min(slice_size, iters - start))
+        for i, start in enumerate(range(0, iters, slice_size))
+    ]
+    workers = min(workers or os.cpu_count() or 1, len(slices))
+    pool = _bootstrap_pool(workers)
+
+    payload = pickle.dumps((metric, items), protocol=pickle.HIGHEST_PROTOCOL)
+    block = shared_memory.SharedMemory(create=True, size=max(len(payload), 1))
+    res = []
+    skipped = 0
+    try:
+        block.buf[: len(payload)] = payload
+        for values, slice_skipped in pool.imap(
+            _bootstrap_slice,
+            [(block.name, len(payload), i, resamples) for i, resamples in slices],
+        ):
+            res.extend(values)
+            skipped += slice_skipped
+    finally:
+        block.close()
+        block.unlink()
+    if skipped:
+        warnings.warn(
+            f"bootstrap of {getattr(metric, '__name__', metric)}: skipped "
+            f"{skipped} of {iters} resamples with nothing to score"
+        )
+    if len(res) < 2:
+        return float("nan")
+    return lm_eval.metrics.sample_stddev(res)
+
+
+def counts_bootstrap_stderr(stat, counts, iters):
+    """Bootstrap stderr of a statistic of the summed count rows of the items.
+
+    The resamples are those `parallel_bootstrap_stderr` draws from a list of
+    as many items, so the result is the same as bootstrapping a metric of
+    the items that only depends on the sum of their counts. Each resample is
+    an array sum instead of a call of the metric.
+
+    :param stat: Callable
+        (resamples, columns) matrix of summed counts -> value of every row
+    :param counts: Sequence[Sequence[int]]
+        Count row of every item
+    """
+    counts = np.asarray(counts, dtype=np.int64).reshape(len(counts), -1)
+    population = range(len(counts))
+    slice_size = math.ceil(iters / PARALLEL_SLICES)
+    totals = []
+    for i, start in enumerate(range(0, iters, slice_size)):
+        rnd = random.Random(BOOTSTRAP_SEED + i)
+        for _ in range(min(slice_size, iters - start)):
+            totals.append(counts[rnd.choices(population, k=len(counts))].sum(axis=0))
+    return lm_eval.metrics.sample_stddev(list(stat(np.array(totals))))
+
+
+def stderr_for_metric(metric, bootstrap_iters):
+    """Like `lm_eval.metrics.stderr_for_metric`, preferring the FLARE bootstraps."""
+    stat = getattr(metric, "vectorised_stat", None)
+    if stat is not None:
+        print("bootstrapping for stddev (vectorised):", metric.__name__)
+        return lambda items: confusion_bootstrap_stderr(
+            stat, *encode_pairs(items), iters=bootstrap_iters
+        )
+
+    if getattr(metric, "parallel_bootstrap", False):
+        print("bootstrapping for stddev (parallel):", metric.__name__)
+        return lambda items: parallel_bootstrap_stderr(
+            metric, items, iters=bootstrap_iters
+        )
+
+    return lm_eval.metrics.stderr_for_metric(
+        metric=metric, bootstrap_iters=bootstrap_iters
+    )
@@ -0,0 +1,127 @@
+"""
+Entity-level F1 of BIO-labelled sentences, as computed by seqeval.
+
+This is seqeval's default (non-strict) mode: `get_entities` is a port of
+`seqeval.metrics.sequence_labeling.get_entities`, and the micro F1 is
+computed from the summed entity counts of the sentences. seqeval separates
+the sentences with an "O" before extracting the entities, so as long as
+the labels are NE tags no entity spans two sentences, and the counts of a
+list of sentences are the sums of the counts of each one. A sentence is
+therefore parsed once into its `entity_counts`, and the F1 of any resample
+of sentences is a sum of their count rows.
+"""
+
+import functools
+import warnings
+
+import numpy as np
+
+
+@functools.lru_cache(maxsize=None)
+def parse_label(label):
+    """(tag, type) of a BIO label, e.g. ("B", "PER") for "B-PER" and ("O", "_") for "O"."""
+    if label not in ("O", "B", "I", "E", "S") and not label.startswith(
+        ("B-", "I-", "E-", "S-")
+    ):
+        # an entity of such tags can run on into the next sentence in seqeval
+        warnings.warn(f"{label} seems not to be NE tag.")
+    return label[0], label[1:].split("-", maxsplit=1)[-1] or "_"
+
+
+def end_of_chunk(prev_tag, tag, prev_type, type_):
+    """Whether a chunk ended between the previous and the current label."""
+    if prev_tag in ("E", "S"):
+        return True
+    if prev_tag in ("B", "I") and tag in ("B", "S", "O"):
+        return True
+    return prev_tag != "O" and prev_tag != "." and prev_type != type_
+
+
+def start_of_chunk(prev_tag, tag, prev_type, type_):
+    """Whether a chunk started between the previous and the current label."""
+    if tag in ("B", "S"):
+        return True
+    if prev_tag in ("E", "S", "O") and tag in ("E", "I"):
+        return True
+    return tag != "O" and tag != "." and prev_type != type_
+
+
+def get_entities(seq):
+    """(type, start, end) of every entity of a sentence, `end` included.
+
+    >>> get_entities(["B-PER", "I-PER", "O", "B-LOC"])
+    [('PER', 0, 1), ('LOC', 3, 3)]
+    """
+    prev_tag = "O"
+    prev_type = ""
+    begin_offset = 0
+    chunks = []
+    for i, label in enumerate(seq):
+        tag, type_ = parse_label(label)
+        if end_of_chunk(prev_tag, tag, prev_type, type_):
+            chunks.append((prev_type, begin_offset, i - 1))
+        if start_of_chunk(prev_tag, tag, prev_type, type_):
+            begin_offset = i
+        prev_tag = tag
+        prev_type = type_
+    # the sentence ends with an "O"
+    if end_of_chunk(prev_tag, "O", prev_type, "_"):
+        chunks.append((prev_type, begin_offset, len(seq) - 1))
+    return chunks
+
+
+def entity_counts(gold, pred):
+    """(correct, predicted, true) entities of one sentence.
+
+    Summed over sentences, these are the counts of seqeval if the labels are
+    NE tags, see `parse_label`.
+
+    :raises ValueError: if `gold` and `pred` differ in length, as in seqeval
+    """
+    if len(gold) != len(pred):
+        raise ValueError(
+            f"Found input variables with inconsistent numbers of samples: {[len(gold), len(pred)]}"
+        )
+    true = set(get_entities(gold))
+    predicted = set(get_entities(pred))
+    return len(true & predicted), len(predicted), len(true)
+
+
+def entity_f1_stat(totals):
+    """seqeval micro F1 of every row of a (rows, 3) matrix of summed `entity_counts`."""
+    totals = np.atleast_2d(np.asarray(totals, dtype=np.float64))
+    correct, predicted, true = totals[:, 0], totals[:, 1], totals[:, 2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(predicted > 0, correct / predicted, 0.0)
+        recall = np.where(true > 0, correct / true, 0.0)
+        denom = precision + recall
+        return np.where(denom > 0, 2 * precision * recall / denom, 0.0)
+
+
+def counts_f1(counts):
+    """seqeval micro F1 of the sentences given by their `entity_counts`."""
+    totals = np.asarray(counts, dtype=np.int64).reshape(-1, 3).sum(axis=0)
+    return float(entity_f1_stat(totals)[0])
+
+
+def entity_f1(golds, preds):
+    """`seqeval.metrics.f1_score(golds, preds)` of lists of labelled sentences.
+
+    :raises ValueError: if the lists or any of their sentences differ in length
+    """
+    if len(golds) != len(preds):
+        raise ValueError(
+            f"Found input variables with inconsistent numbers of samples: {[len(golds), len(preds)]}"
+        )
+    # sentences joined by an "O" as in seqeval, which is exact whatever the labels
+    flat_golds, flat_preds = [], []
+    for gold, pred in zip(golds, preds):
+        if len(gold) != len(pred):
+            raise ValueError(
+                f"Found input variables with inconsistent numbers of samples: {[len(gold), len(pred)]}"
+            )
+        flat_golds.extend(gold)
+        flat_golds.append("O")
+        flat_preds.extend(pred)
+        flat_preds.append("O")
+    return counts_f1([entity_counts(flat_golds, flat_preds)])
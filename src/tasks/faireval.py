@@ -208,28 +208,58 @@ class FairevalEngine:
         self.task_type = task_type
         self.prompt_mode = prompt_mode
         self.set_prompt_index = None
+        self.doc_views = {}
 
-    def randomise_prompt(self, doc):
+    def parse_doc(self, doc):
+        """Parse the prompt-independent fields of a doc.
+
+        Returns a dict with the matched category keys, the stock/date fields of
+        "sm" queries and the cleaned text, so that every prompt template can be
+        rendered from it without re-splitting the query.
+        """
+        categories = []
+        for category in range(self.prompt_categories):
+            matched = [k for k in self.prompt_mapping[category] if k in doc["query"]]
+            if not matched:
+                logger.info(doc["query"])
+                raise ValueError("Invalid prompt format")
+            categories.append(matched)
+        view = {"categories": categories, "clean_text": self.clean_text(doc)}
+        if self.task_type == "sm":
+            view["stock"] = re.search(r"closing price of (.*?) ", doc["query"]).group(1)
+            view["date"] = re.search(r"at (.*?)[\?.]", doc["query"]).group(1)
+        return view
+
+    def prepare_docs(self, docs):
+        """Parse `docs` once and keep the views until `release_docs` is called."""
+        self.doc_views = {id(doc): self.parse_doc(doc) for doc in docs}
+
+    def release_docs(self):
+        self.doc_views = {}
+
+    def get_doc_view(self, doc):
+        view = self.doc_views.get(id(doc))
+        if view is None:
+            view = self.parse_doc(doc)
+        return view
+
+    def randomise_prompt(self, doc, view=None):
+        if view is None:
+            view = self.get_doc_view(doc)
         if self.set_prompt_index:
             prompt = self.prompt_mapping["template"][self.set_prompt_index]
         else:
             prompt = random.choice(self.prompt_mapping["template"])
-        for category in range(self.prompt_categories):
+        for category, matched in enumerate(view["categories"]):
             category_mapping = self.prompt_mapping[category]
             replacements = {}
-            for k in category_mapping.keys():
-                if k in doc["query"]:
-                    replacements[f"category_{category}"] = random.choice(
-                        category_mapping[k]
-                    )
-            if f"category_{category}" not in replacements:
-                logger.info(doc["query"])
-                raise ValueError("Invalid prompt format")
+            for k in matched:
+                replacements[f"category_{category}"] = random.choice(
+                    category_mapping[k]
+                )
             prompt = prompt.format(**replacements)
         if self.task_type == "sm":
-            stock = re.search(r"closing price of (.*?) ", doc["query"]).group(1)
-            date = re.search(r"at (.*?)[\?.]", doc["query"]).group(1)
-            prompt = prompt.format(stock=stock, date=date)
+            prompt = prompt.format(stock=view["stock"], date=view["date"])
         return prompt
 
     def set_prompt(self, prompt_index):
@@ -275,7 +305,8 @@ class FairevalEngine:
                 raise ValueError("Invalid query format")
 
     def doc_to_text(self, doc, answer_phrase=" Answer:"):
-        return self.randomise_prompt(doc) + self.clean_text(doc) + answer_phrase
+        view = self.get_doc_view(doc)
+        return self.randomise_prompt(doc, view) + view["clean_text"] + answer_phrase
 
     def get_prompt_count(self):
         return len(self.prompt_mapping["template"])
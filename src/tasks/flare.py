@@ -15,9 +15,20 @@ from .faireval import (
     CONVFINQA_PROMPTS,
     SM_PROMPTS,
 )
-from .utils import process_text, process_text_fingpt
-from .zhutils import process_zhtext
-from seqeval.metrics import f1_score as entity_score
+from .utils import align_entities_batch, parse_entities, parse_entities_fingpt
+from .zhutils import parse_zhentities
+from .bootstrap import (
+    vectorised,
+    parallel,
+    ConfusionMatrix,
+    binary_mean_stderr,
+    parallel_bootstrap_stderr,
+    counts_bootstrap_stderr,
+    EmptyResample,
+)
+from .matching import ChoiceMatcher
+from .entities import entity_counts, counts_f1, entity_f1_stat
+from .entities import entity_f1 as entity_score
 from sklearn.metrics import f1_score, matthews_corrcoef, mean_squared_error
 from bart_score import BARTScorer
 import evaluate
@@ -25,6 +36,7 @@ import re
 from factscore_package.factscorer import FactScorer
 import os
 import random
+import collections
 
 # from comet import download_model, load_from_checkpoint
 
@@ -42,12 +54,41 @@ _CITATION = """
 random.seed(42)
 
 
+def cells_f1(items):
+    """Weighted label F1 of the sentences of `items`, given by their (gold, pred) cell counts."""
+    cells = collections.Counter()
+    for doc_cells in items:
+        for cell, count in doc_cells:
+            cells[cell] += count
+    golds, preds = zip(*cells)
+    return f1_score(
+        golds, preds, average="weighted", sample_weight=list(cells.values())
+    )
+
+
+
 class Classification(Task):
+    # stop sequences and maximal number of generated tokens of every request.
+    # No newline stop, chat models often open their answer with one
+    GENERATION = {"until": None, "max_length": 20}
     CALCULATE_MCC = True
     LOWER_CASE = True
     VERSION = 1
     EVAL_LAST_TURN = True
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # ChoiceMatcher of every set of choices of the dataset, built once here
+        self.choice_matchers = {}
+        for split in self.dataset.values():
+            if hasattr(split, "column_names"):
+                # a datasets.Dataset, read by column without decoding every row
+                choices = split["choices"] if "choices" in split.column_names else []
+            else:
+                choices = [doc["choices"] for doc in split if "choices" in doc]
+            for doc_choices in choices:
+                self.choice_matcher({"choices": doc_choices})
+
     def reformulate_turn_req(self, req, turn_request, turn):
         return req
 
@@ -80,7 +121,7 @@ class Classification(Task):
             language description, as well as the few shot examples, and the question
             part of the document for `doc`.
         """
-        cont_request = rf.greedy_until(ctx, {"until": None})
+        cont_request = rf.greedy_until(ctx, self.GENERATION)
         return cont_request
 
     def doc_to_decontamination_query(self, doc):
@@ -94,21 +135,75 @@ class Classification(Task):
         # TODO: Format the query prompt portion of the document example.
         return doc["answer"]
 
+    def answer_words(self, doc):
+        """Lower-cased words completing an answer, for backends that stream it.
+
+        Case-sensitive tasks have none, their choices are too short to close
+        a stream on.
+        """
+        if not self.LOWER_CASE:
+            return None
+        return [choice.lower() for choice in doc["choices"]]
+
+    def choice_alternatives(self, doc):
+        """For every choice of `doc` in priority order, the strings that select it."""
+        if self.LOWER_CASE:
+            return tuple((choice.lower(),) for choice in doc["choices"])
+        return tuple((choice,) for choice in doc["choices"])
+
+    def choice_matcher(self, doc):
+        """The ChoiceMatcher of the choices of `doc`, built if the dataset did not have them."""
+        choices = tuple(doc["choices"])
+        matcher = self.choice_matchers.get(choices)
+        if matcher is None:
+            matcher = self.choice_matchers[choices] = ChoiceMatcher(
+                self.choice_alternatives(doc)
+            )
+        return matcher
+
+    def extract_answer(self, doc, response):
+        """The first choice of `doc` found in `response`, None if there is none."""
+        ini_result = response.strip()
+        if self.LOWER_CASE:
+            ini_result = ini_result.lower()
+        matcher = self.choice_matcher(doc)
+        index = matcher.match(ini_result)
+        return None if index is None else matcher.choices[index]
+
+    def extract_answers(self, docs, responses):
+        """`extract_answer` of every doc of `docs` and its response.
+
+        The responses are matched in one `ChoiceMatcher.match_batch` call per
+        set of choices.
+        """
+        texts = [response.strip() for response in responses]
+        if self.LOWER_CASE:
+            texts = [text.lower() for text in texts]
+        groups = collections.defaultdict(list)
+        for pos, doc in enumerate(docs):
+            groups[tuple(doc["choices"])].append(pos)
+        answers = [None] * len(docs)
+        for positions in groups.values():
+            matcher = self.choice_matcher(docs[positions[0]])
+            indices = matcher.match_batch([texts[pos] for pos in positions])
+            for pos, index in zip(positions, indices):
+                answers[pos] = None if index is None else matcher.choices[index]
+        return answers
+
     def process_results(self, doc, results):
+        return self.score_answer(doc, self.extract_answer(doc, results[0]))
+
+    def process_results_batch(self, docs, results):
+        """`process_results` of many docs, their answers extracted together."""
+        answers = self.extract_answers(docs, [doc_results[0] for doc_results in results])
+        return [self.score_answer(doc, answer) for doc, answer in zip(docs, answers)]
+
+    def score_answer(self, doc, result):
+        """Metrics of `doc` for its extracted answer `result`, None if no choice was found."""
         gold: str = doc["choices"][doc["gold"]]
         if self.LOWER_CASE:
             gold = gold.lower()
-        ini_result = results[0].strip()
-        if self.LOWER_CASE:
-            ini_result = ini_result.lower()
 
-        result = None
-        for choice in doc["choices"]:
-            if self.LOWER_CASE:
-                choice = choice.lower()
-            if choice in ini_result:
-                result = choice
-                break
         if result is None:
             result = "missing"
 
@@ -137,6 +232,7 @@ class Classification(Task):
             metrics["mcc"] = True
         return metrics
 
+    @vectorised("weighted_f1")
     def weighted_f1(self, items):
         preds, golds = zip(*items)
         labels = list(set(golds))
@@ -145,6 +241,7 @@ class Classification(Task):
         f1 = f1_score(golds, preds, average="weighted", labels=labels)
         return f1
 
+    @vectorised("macro_f1")
     def macro_f1(self, items):
         preds, golds = zip(*items)
         labels = list(set(golds))
@@ -153,6 +250,7 @@ class Classification(Task):
         f1 = f1_score(golds, preds, average="macro", labels=labels)
         return f1
 
+    @vectorised("mcc")
     def matthews_corrcoef(self, items):
         preds, golds = zip(*items)
         labels = {label: i for i, label in enumerate(list(set(golds)))}
@@ -171,8 +269,41 @@ class Classification(Task):
             metrics["mcc"] = self.matthews_corrcoef
         return metrics
 
+    def init_state(self):
+        """Running state of the metrics of one prompt, fed by `update`."""
+        return ConfusionMatrix()
+
+    def update(self, state, doc, metrics):
+        """Fold the `process_results` of one doc into `state`."""
+        state.add(*metrics["f1"])
+
+    def finalize(self, state, bootstrap_iters):
+        """(value, stderr) of every metric, in closed form from the confusion matrix.
+
+        The values are those of `aggregation` and the stderrs those of
+        `bootstrap.stderr_for_metric` on the items of every doc.
+        """
+        correct = state.correct()
+        missing = state.predicted("missing")
+        results = {
+            "acc": (correct / state.n, binary_mean_stderr(correct, state.n)),
+            "missing": (missing / state.n, binary_mean_stderr(missing, state.n)),
+            "f1": (
+                state.stat("weighted_f1"),
+                state.stderr("weighted_f1", bootstrap_iters),
+            ),
+            "macro_f1": (
+                state.stat("macro_f1"),
+                state.stderr("macro_f1", bootstrap_iters),
+            ),
+        }
+        if self.CALCULATE_MCC:
+            results["mcc"] = (state.stat("mcc"), state.stderr("mcc", bootstrap_iters))
+        return results
+
 
 class SequentialLabeling(Task):
+    GENERATION = {"until": None, "max_length": 512}
     VERSION = 1
     DATASET_NAME = None
     LMAP = {"O": 0}
@@ -229,7 +360,7 @@ class SequentialLabeling(Task):
             language description, as well as the few shot examples, and the question
             part of the document for `doc`.
         """
-        cont_request = rf.greedy_until(ctx, {"until": None})
+        cont_request = rf.greedy_until(ctx, self.GENERATION)
         return cont_request
 
     def process_result(self, pred, gold, tokens):
@@ -243,6 +374,7 @@ class SequentialLabeling(Task):
                 format_pred[index] = label
         return format_pred
 
+    @parallel
     def entity_f1(self, items):
         golds, preds, tokens = zip(*items)
 
@@ -264,6 +396,7 @@ class SequentialLabeling(Task):
                 format_pred[index] = self.LMAP.get(label, -1)
         return format_pred
 
+    @parallel
     def label_f1(self, items):
         golds, preds, tokens = zip(*items)
 
@@ -282,8 +415,46 @@ class SequentialLabeling(Task):
             "f1": self.label_f1,
         }
 
+    def init_state(self):
+        """Running state of the metrics of one prompt, fed by `update`.
+
+        The bootstraps resample docs, so it keeps a summary per doc, but not
+        its tokens and response: its entity counts and its label cells.
+        """
+        return {"entity_f1": [], "f1": []}
+
+    def update(self, state, doc, metrics):
+        """Fold the `process_results` of one doc into `state`."""
+        gold, pred, tokens = metrics["f1"]
+        state["entity_f1"].append(
+            entity_counts(gold, self.process_result(pred, gold, tokens))
+        )
+        cells = collections.Counter(
+            zip(
+                [self.LMAP[label] for label in gold],
+                self.process_label_result(pred, gold, tokens),
+            )
+        )
+        state["f1"].append(tuple(cells.items()))
+
+    def finalize(self, state, bootstrap_iters):
+        """(value, stderr) of every metric, equal to those of `aggregation` on the items."""
+        return {
+            "entity_f1": (
+                counts_f1(state["entity_f1"]),
+                counts_bootstrap_stderr(
+                    entity_f1_stat, state["entity_f1"], iters=bootstrap_iters
+                ),
+            ),
+            "f1": (
+                cells_f1(state["f1"]),
+                parallel_bootstrap_stderr(cells_f1, state["f1"], iters=bootstrap_iters),
+            ),
+        }
+
 
 class AbstractiveSummarization(Task):
+    GENERATION = {"until": None, "max_length": 512}
     VERSION = 1
     DATASET_NAME = None
     EVAL_LAST_TURN = True
@@ -345,7 +516,7 @@ class AbstractiveSummarization(Task):
             language description, as well as the few shot examples, and the question
             part of the document for `doc`.
         """
-        cont_request = rf.greedy_until(ctx, {"until": None})
+        cont_request = rf.greedy_until(ctx, self.GENERATION)
         return cont_request
 
     def rouge_score(self, items):
@@ -354,14 +525,17 @@ class AbstractiveSummarization(Task):
         results = rouge.compute(predictions=preds, references=golds)
         return results
 
+    @parallel
     def rouge1(self, items):
         results = self.rouge_score(items)
         return results["rouge1"]
 
+    @parallel
     def rouge2(self, items):
         results = self.rouge_score(items)
         return results["rouge2"]
 
+    @parallel
     def rougeL(self, items):
         results = self.rouge_score(items)
         return results["rougeL"]
@@ -401,6 +575,7 @@ class AbstractiveSummarization(Task):
 
 
 class ExtractiveSummarization(Task):
+    GENERATION = {"until": None, "max_length": 512}
     VERSION = 1
     DATASET_NAME = None
     EVAL_LAST_TURN = True
@@ -462,7 +637,7 @@ class ExtractiveSummarization(Task):
             language description, as well as the few shot examples, and the question
             part of the document for `doc`.
         """
-        cont_request = rf.greedy_until(ctx, {"until": None})
+        cont_request = rf.greedy_until(ctx, self.GENERATION)
         return cont_request
 
     def get_sum(self, labels, texts):
@@ -487,14 +662,17 @@ class ExtractiveSummarization(Task):
         results = rouge.compute(predictions=preds, references=golds)
         return results
 
+    @parallel
     def rouge1(self, items):
         results = self.rouge_score(items)
         return results["rouge1"]
 
+    @parallel
     def rouge2(self, items):
         results = self.rouge_score(items)
         return results["rouge2"]
 
+    @parallel
     def rougeL(self, items):
         results = self.rouge_score(items)
         return results["rougeL"]
@@ -540,6 +718,7 @@ class ExtractiveSummarization(Task):
 
 
 class RelationExtraction(Task):
+    GENERATION = {"until": None, "max_length": 256}
     VERSION = 1
     DATASET_NAME = None
     EVAL_LAST_TURN = True
@@ -597,7 +776,7 @@ class RelationExtraction(Task):
             language description, as well as the few shot examples, and the question
             part of the document for `doc`.
         """
-        cont_request = rf.greedy_until(ctx, {"until": None})
+        cont_request = rf.greedy_until(ctx, self.GENERATION)
         return cont_request
 
     def process(self, items):
@@ -613,18 +792,23 @@ class RelationExtraction(Task):
 
         return set(all_golds), set(all_preds)
 
+    @parallel
     def precision(self, items):
         golds, preds = self.process(items)
         tp = golds & preds
         prec = len(tp) / len(preds)
         return prec
 
+    @parallel
     def recall(self, items):
         golds, preds = self.process(items)
+        if not golds:
+            raise EmptyResample("no gold relation to recall")
         tp = golds & preds
         rec = len(tp) / len(golds)
         return rec
 
+    @parallel
     def cal_f1(self, items):
         prec = self.precision(items)
         rec = self.recall(items)
@@ -641,6 +825,7 @@ class RelationExtraction(Task):
 
 
 class QA(Task):
+    GENERATION = {"until": None, "max_length": 256}
     VERSION = 1
     DATASET_NAME = None
     EVAL_LAST_TURN = True
@@ -687,7 +872,7 @@ class QA(Task):
             language description, as well as the few shot examples, and the question
             part of the document for `doc`.
         """
-        cont_request = rf.greedy_until(ctx, {"until": None})
+        cont_request = rf.greedy_until(ctx, self.GENERATION)
         return cont_request
 
     def doc_to_target(self, doc):
@@ -712,6 +897,20 @@ class QA(Task):
             "acc": mean,
         }
 
+    def init_state(self):
+        """Running state of the metrics of one prompt: correct answers and docs."""
+        return [0, 0]
+
+    def update(self, state, doc, metrics):
+        """Fold the `process_results` of one doc into `state`."""
+        state[0] += metrics["acc"]
+        state[1] += 1
+
+    def finalize(self, state, bootstrap_iters):
+        """(value, stderr) of every metric, in closed form from the counts."""
+        correct, n = state
+        return {"acc": (correct / n, binary_mean_stderr(correct, n))}
+
 
 class FPB(Classification):
     DATASET_PATH = "chancefocus/flare-fpb"
@@ -722,6 +921,7 @@ class FIQASA(Classification):
 
 
 class NER(Task):
+    GENERATION = {"until": None, "max_length": 256}
     VERSION = 1
     DATASET_PATH = "chancefocus/flare-ner"
     DATASET_NAME = None
@@ -769,17 +969,33 @@ class NER(Task):
             language description, as well as the few shot examples, and the question
             part of the document for `doc`.
         """
-        cont_request = rf.greedy_until(ctx, {"until": None})
+        cont_request = rf.greedy_until(ctx, self.GENERATION)
         return cont_request
 
     def doc_to_target(self, doc):
         return doc["answer"]
 
+    def doc_words(self, doc):
+        """Text of `doc` whose words are labelled."""
+        return doc["text"]
+
+    def parse_entities(self, response):
+        """`(entity, entity_type)` pairs of a response."""
+        return parse_entities(response)
+
     def process_results(self, doc, results):
-        text = doc["text"]
-        pred = process_text(results[0], text)
+        return self.process_results_batch([doc], [results])[0]
 
-        return {"entity_f1": (pred, doc["label"], results[0])}
+    def process_results_batch(self, docs, results):
+        """`process_results` of many docs, their entities aligned in one batch."""
+        preds = align_entities_batch(
+            [self.doc_words(doc) for doc in docs],
+            [self.parse_entities(doc_results[0]) for doc_results in results],
+        )
+        return [
+            {"entity_f1": (pred, doc["label"], doc_results[0])}
+            for pred, doc, doc_results in zip(preds, docs, results)
+        ]
 
     def higher_is_better(self):
         return {
@@ -787,6 +1003,7 @@ class NER(Task):
         }
 
     @classmethod
+    @parallel
     def entity_f1(cls, items):
         preds, golds, _ = zip(*items)
         f1 = entity_score(golds, preds)
@@ -797,6 +1014,24 @@ class NER(Task):
             "entity_f1": self.entity_f1,
         }
 
+    def init_state(self):
+        """Running state of the metrics of one prompt: the entity counts of every doc."""
+        return []
+
+    def update(self, state, doc, metrics):
+        """Fold the `process_results` of one doc into `state`."""
+        pred, gold, _ = metrics["entity_f1"]
+        state.append(entity_counts(gold, pred))
+
+    def finalize(self, state, bootstrap_iters):
+        """(value, stderr) of every metric, equal to those of `aggregation` on the items."""
+        return {
+            "entity_f1": (
+                counts_f1(state),
+                counts_bootstrap_stderr(entity_f1_stat, state, iters=bootstrap_iters),
+            )
+        }
+
 
 class FinQA(QA):
     DATASET_PATH = "chancefocus/flare-finqa"
@@ -811,23 +1046,23 @@ class StockMovement(Classification):
     }
     DEFAULT = "fall"
 
-    def process_results(self, doc, results):
+    def answer_words(self, doc):
+        words = super().answer_words(doc)
+        if words is None:
+            return None
+        return words + [val for vals in self.CHOICE_DICT.values() for val in vals]
+
+    def choice_alternatives(self, doc):
+        return tuple(
+            (choice, *self.CHOICE_DICT[choice])
+            for (choice,) in super().choice_alternatives(doc)
+        )
+
+    def score_answer(self, doc, result):
         gold: str = doc["choices"][doc["gold"]]
         if self.LOWER_CASE:
             gold = gold.lower()
-        ini_result = results[0].strip()
-        if self.LOWER_CASE:
-            ini_result = ini_result.lower()
 
-        result = None
-        for choice in doc["choices"]:
-            if self.LOWER_CASE:
-                choice = choice.lower()
-            if choice in ini_result or any(
-                [val in ini_result for val in self.CHOICE_DICT[choice]]
-            ):
-                result = choice
-                break
         if result is None:
             result = self.DEFAULT
 
@@ -867,6 +1102,15 @@ SM_TASKS = {
 
 class Headlines(Classification):
     DATASET_PATH = "chancefocus/flare-headlines"
+    # avg_f1 is averaged over label types, it does not fold into one confusion matrix
+    init_state = None
+
+    # the whole response is compared to "Yes", no answer is extracted
+    process_results_batch = None
+
+    def answer_words(self, doc):
+        # the whole answer is compared to "Yes", so it is never cut short
+        return None
 
     def process_results(self, doc, results):
         gold = doc["gold"]
@@ -911,7 +1155,7 @@ class Headlines(Classification):
             language description, as well as the few shot examples, and the question
             part of the document for `doc`.
         """
-        cont_request = rf.greedy_until(ctx, {"until": None})
+        cont_request = rf.greedy_until(ctx, self.GENERATION)
         return cont_request
 
     def aggregation(self):
@@ -976,6 +1220,7 @@ class ConvFinQA(QA):
 
 
 class TSA(Task):
+    GENERATION = {"until": ["Answer:"], "max_length": 20}
     VERSION = 1
     DATASET_PATH = "chancefocus/flare-tsa"
     DATASET_NAME = None
@@ -1038,9 +1283,10 @@ class TSA(Task):
             language description, as well as the few shot examples, and the question
             part of the document for `doc`.
         """
-        cont_request = rf.greedy_until(ctx, {"until": "Answer:"})
+        cont_request = rf.greedy_until(ctx, self.GENERATION)
         return cont_request
 
+    @parallel
     def rmse(self, items):
         golds, preds = zip(*items)
         fgolds, fpreds = [], []
@@ -1049,7 +1295,9 @@ class TSA(Task):
                 continue
             fgolds.append(gold)
             fpreds.append(max(min(pred, 1.0), -1.0))
-        rmse = mean_squared_error(fgolds, fpreds, squared=True)
+        if not fgolds:
+            raise EmptyResample("no prediction to score, all are missing")
+        rmse = float(np.sqrt(mean_squared_error(fgolds, fpreds)))
 
         return rmse
 
@@ -1059,6 +1307,26 @@ class TSA(Task):
             "missing": mean,
         }
 
+    def init_state(self):
+        """Running state of the metrics of one prompt: the (gold, pred) of every doc."""
+        return []
+
+    def update(self, state, doc, metrics):
+        """Fold the `process_results` of one doc into `state`."""
+        state.append(metrics["rmse"])
+
+    def finalize(self, state, bootstrap_iters):
+        """(value, stderr) of every metric, equal to those of `aggregation` on the items."""
+        # a response without a number is predicted as -100.0
+        missing = sum(pred == -100.0 for _, pred in state)
+        return {
+            "rmse": (
+                self.rmse(state),
+                parallel_bootstrap_stderr(self.rmse, state, iters=bootstrap_iters),
+            ),
+            "missing": (missing / len(state), binary_mean_stderr(missing, len(state))),
+        }
+
 
 class CFA(Classification):
     DATASET_PATH = "chancefocus/flare-cfa"
@@ -1296,6 +1564,7 @@ class travelinsurace(Classification):
 
 
 class LongFormFactuality(Task):
+    GENERATION = {"until": None, "max_length": 512}
     VERSION = 1
     DATASET_NAME = None
     EVAL_LAST_TURN = True
@@ -1346,7 +1615,7 @@ class LongFormFactuality(Task):
             language description, as well as the few shot examples, and the question
             part of the document for `doc`.
         """
-        cont_request = rf.greedy_until(ctx, {"until": None})
+        cont_request = rf.greedy_until(ctx, self.GENERATION)
         return cont_request
 
     def factscore(self, items):
@@ -1502,11 +1771,12 @@ class ZH22CCKS(ZH19CCKS):
 class ZHNER(NER):
     DATASET_PATH = "ChanceFocus/flare-zh-ner"
 
-    def process_results(self, doc, results):
-        text = " ".join(doc["text"])
-        pred = process_zhtext(results[0], text)
+    def doc_words(self, doc):
+        # every character is a word
+        return " ".join(doc["text"])
 
-        return {"entity_f1": (pred, doc["label"], results[0])}
+    def parse_entities(self, response):
+        return parse_zhentities(response)
 
 
 class ZHFPB(Classification):
@@ -1620,12 +1890,8 @@ class NERFinGPT(NER):
             "Text: ", "Input: "
         )
 
-    def process_results(self, doc, results):
-
-        text = doc["text"]
-        pred = process_text_fingpt(results[0], text)
-
-        return {"entity_f1": (pred, doc["label"], results[0])}
+    def parse_entities(self, response):
+        return parse_entities_fingpt(response)
 
 
 class FairevalMixin:
@@ -1638,6 +1904,61 @@ class FairevalMixin:
     def set_prompt(self, prompt_index):
         self.faireval_engine.set_prompt(prompt_index)
 
+    def prepare_faireval_docs(self, docs):
+        self.faireval_engine.prepare_docs(docs)
+
+    def release_faireval_docs(self):
+        self.faireval_engine.release_docs()
+
+
+class ChoiceScoringMixin:
+    """Score a Classification task by ranking its choices instead of generating.
+
+    Each choice is scored as a continuation of the prompt by loglikelihood,
+    which the LM computes without autoregressive decoding, and the most
+    likely one is scored by the task as if it had been generated. Needs a
+    backend that implements `loglikelihood`.
+
+    A longer continuation sums more negative token loglikelihoods, so with
+    `LENGTH_NORMALIZED` the choices are ranked by loglikelihood per character
+    of the continuation, which does not favour the labels of fewer tokens
+    and does not depend on the tokenizer. Set it to False to rank by the
+    summed loglikelihood.
+    """
+
+    LENGTH_NORMALIZED = True
+
+    def construct_requests(self, doc, ctx):
+        return [rf.loglikelihood(ctx, " " + choice)[0] for choice in doc["choices"]]
+
+    def best_choice(self, doc, results):
+        """The choice of `doc` ranked first by the loglikelihoods `results`."""
+        scores = np.asarray(results, dtype=np.float64)
+        if self.LENGTH_NORMALIZED:
+            scores = scores / [len(" " + choice) for choice in doc["choices"]]
+        return doc["choices"][int(np.argmax(scores))]
+
+    def process_results(self, doc, results):
+        return super().process_results(doc, [self.best_choice(doc, results)])
+
+    def process_results_batch(self, docs, results):
+        best = [
+            [self.best_choice(doc, doc_results)]
+            for doc, doc_results in zip(docs, results)
+        ]
+        return super().process_results_batch(docs, best)
+
+
+def choice_scoring(task_class):
+    """Variant of a Classification task class that ranks the choices by loglikelihood."""
+    # tasks scoring each response on its own, such as Headlines, stay so
+    namespace = {} if task_class.process_results_batch is not None else {
+        "process_results_batch": None
+    }
+    return type(
+        task_class.__name__ + "Choice", (ChoiceScoringMixin, task_class), namespace
+    )
+
 
 class FairevalFPB(FairevalMixin, FPB):
     faireval_engine = FairevalEngine(FPB_PROMPTS, 0, "text")
@@ -0,0 +1,39 @@
+"""
+Answer extraction for classification tasks.
+
+A response is matched against the choices of a doc in priority order: the
+first choice that occurs anywhere in the response wins, whatever its
+position. A `ChoiceMatcher` is built once per set of choices, with the
+strings selecting each choice (the choice and its synonyms) flattened in
+priority order, so a match is only a run of substring checks.
+"""
+
+
+class ChoiceMatcher:
+    """Priority-ordered matcher of the choices of a classification task."""
+
+    def __init__(self, alternatives):
+        """
+
+        :param alternatives: Sequence[Sequence[str]]
+            For every choice in priority order, the strings any of which
+            selects it, the choice itself first
+        """
+        self.choices = tuple(strings[0] for strings in alternatives)
+        # (string, index of its choice), the strings of each choice deduplicated
+        self.patterns = tuple(
+            (string, index)
+            for index, strings in enumerate(alternatives)
+            for string in dict.fromkeys(strings)
+        )
+
+    def match(self, text):
+        """Index of the first choice occurring in `text`, None if none does."""
+        for string, index in self.patterns:
+            if string in text:
+                return index
+        return None
+
+    def match_batch(self, texts):
+        """`match` of every text of `texts`."""
+        return [self.match(text) for text in texts]
@@ -1,96 +1,99 @@
-def process_text(entity_string, text):
-    # Initialize
-    entity_list = [(", ".join(val.split(", ")[:-1]), val.split(", ")[-1]) for val in entity_string.split("\n")]
-    text_words = text.split()
-    labels = ['O'] * len(text_words)
-    # text_lower = text.lower()
-    text_lower = text
-
-    # Create a list to store the start index of each word
-    word_indices = [0]
-    for word in text_words[:-1]:
-        word_indices.append(word_indices[-1] + len(word) + 1)
-
-    # Iterate over the entity list
-    print (entity_list)
-    for entity, entity_type in entity_list:
-        entity_words = entity.split()
-        entity_lower = entity
-
-        # Find start and end index of each occurrence of the entity in the text
-        start = 0
-        while True:
-            start = text_lower.find(entity_lower, start)
-            if not entity or start == -1: break  # No more occurrence
-            end = start + len(entity) - 1
-
-            # Find the words included in this occurrence
-            try:
-                start_word = next(i for i, ind in enumerate(word_indices) if ind >= start)
-                end_word = next(i for i, ind in enumerate(word_indices) if ind > end)
-
-                # Label the words
+import bisect
+
+
+class SpanAligner:
+    """Align entity strings found in a text to BIO labels of its words.
+
+    The words are those of `text.split()`, at the offsets they would have if
+    they were separated by single spaces. Each occurrence of an entity, left
+    to right and non-overlapping, labels the word starting at or after its
+    first character as B- and the following words starting before its last
+    character as I-. Occurrences ending in the last word are skipped, and
+    later entities overwrite the labels of earlier ones.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.words = text.split()
+        # start of every word, sorted as words are never empty
+        self.offsets = [0]
+        for word in self.words[:-1]:
+            self.offsets.append(self.offsets[-1] + len(word) + 1)
+        # entity -> (start word, end word) of each occurrence
+        self._spans = {}
+
+    def spans(self, entity):
+        """(start word, end word) of every labelled occurrence of `entity`, end excluded.
+
+        An entity string is searched once, however often it is listed.
+        """
+        spans = self._spans.get(entity)
+        if spans is not None:
+            return spans
+        spans = []
+        if entity:
+            offsets = self.offsets
+            start = self.text.find(entity)
+            while start != -1:
+                end = start + len(entity) - 1
+                start_word = bisect.bisect_left(offsets, start)
+                end_word = bisect.bisect_right(offsets, end)
+                # no word starts after the occurrence
+                if end_word < len(offsets):
+                    spans.append((start_word, end_word))
+                start = self.text.find(entity, end + 1)
+        self._spans[entity] = spans
+        return spans
+
+    def labels(self, entities):
+        """BIO labels of the words for `(entity, entity_type)` pairs, in order."""
+        labels = ['O'] * len(self.words)
+        for entity, entity_type in entities:
+            for start_word, end_word in self.spans(entity):
                 labels[start_word] = 'B-' + entity_type
-                for i in range(start_word+1, end_word):
-                    labels[i] = 'I-' + entity_type
+                if end_word > start_word + 1:
+                    labels[start_word + 1:end_word] = ['I-' + entity_type] * (end_word - start_word - 1)
+        return labels
 
-                # Move to the next character after the occurrence
-            except Exception:
-                pass
-            start = end + 1
 
-    return labels
+def align_entities(text, entities):
+    """BIO labels of the words of `text` for `(entity, entity_type)` pairs, see `SpanAligner`."""
+    return SpanAligner(text).labels(entities)
 
 
-def process_text_fingpt(entity_string, text):
-    # Initialize
+def align_entities_batch(texts, entity_lists):
+    """`align_entities` of many docs, searching every distinct text only once per entity."""
+    aligners = {}
+    batch = []
+    for text, entities in zip(texts, entity_lists):
+        if text not in aligners:
+            aligners[text] = SpanAligner(text)
+        batch.append(aligners[text].labels(entities))
+    return batch
+
+
+def parse_entities(entity_string):
+    """`(entity, entity_type)` pairs of a response listing "entity, type" lines."""
+    return [(", ".join(val.split(", ")[:-1]), val.split(", ")[-1]) for val in entity_string.split("\n")]
+
 
+def parse_entities_fingpt(entity_string):
+    """`(entity, entity_type)` pairs of a FinGPT response such as "Apple is an organization"."""
     category_map = {
         "organization": "ORG",
         "person": "PER",
         "location": "LOC"
     }
     entity_list = [val.strip(". ").replace(" is an "," is a ").split(" is a ") for val in entity_string.split(", ")]
+    return [
+        (entity, category_map.get(entity_type, entity_type))
+        for entity, entity_type in entity_list
+    ]
 
 
-    text_words = text.split()
-    labels = ['O'] * len(text_words)
-    text_lower = text
-
-    # Create a list to store the start index of each word
-    word_indices = [0]
-    for word in text_words[:-1]:
-        word_indices.append(word_indices[-1] + len(word) + 1)
-
-    # Iterate over the entity list
-    print (entity_list)
-    for entity, entity_type in entity_list:
-        if entity_type in category_map:
-            entity_type = category_map[entity_type]
-        entity_words = entity.split()
-        entity_lower = entity
-
-        # Find start and end index of each occurrence of the entity in the text
-        start = 0
-        while True:
-            start = text_lower.find(entity_lower, start)
-            if not entity or start == -1: break  # No more occurrence
-            end = start + len(entity) - 1
-
-            # Find the words included in this occurrence
-            try:
-                start_word = next(i for i, ind in enumerate(word_indices) if ind >= start)
-                end_word = next(i for i, ind in enumerate(word_indices) if ind > end)
-
-                # Label the words
-                labels[start_word] = 'B-' + entity_type
-                for i in range(start_word+1, end_word):
-                    labels[i] = 'I-' + entity_type
-
-                # Move to the next character after the occurrence
-            except Exception:
-                pass
-            start = end + 1
+def process_text(entity_string, text):
+    return align_entities(text, parse_entities(entity_string))
 
-    return labels
 
+def process_text_fingpt(entity_string, text):
+    return align_entities(text, parse_entities_fingpt(entity_string))
@@ -0,0 +1,75 @@
+import collections
+import gzip
+import json
+import pathlib
+
+
+def _open(path, mode):
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf8")
+    return open(path, mode, encoding="utf8")
+
+
+class WriteOutStream:
+    """Stream `--write_out` details as one compact JSONL record per doc.
+
+    Records are written to `{task_name}_write_out_info.jsonl` (or `.jsonl.gz`
+    when compressed) as soon as a doc has been scored, so nothing is kept in
+    memory until the end of the run.
+    """
+
+    def __init__(self, output_base_path=None, compress=False):
+        """
+
+        :param output_base_path: str, optional
+            Directory the files are written to. Defaults to present working dir
+        :param compress: bool
+            Gzip the JSONL files
+        """
+        self.output_base_path = (
+            pathlib.Path(output_base_path)
+            if output_base_path is not None
+            else pathlib.Path(".")
+        )
+        self.output_base_path.mkdir(parents=True, exist_ok=True)
+        self.suffix = ".jsonl.gz" if compress else ".jsonl"
+        self.files = {}
+
+    def path(self, task_name):
+        return self.output_base_path.joinpath(
+            f"{task_name}_write_out_info{self.suffix}"
+        )
+
+    def write(self, task_name, record):
+        fp = self.files.get(task_name)
+        if fp is None:
+            fp = self.files[task_name] = _open(self.path(task_name), "w")
+        fp.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def close(self):
+        for fp in self.files.values():
+            fp.close()
+        self.files = {}
+
+
+def read_write_out(path):
+    """Yield the records of a (possibly gzipped) write_out JSONL file."""
+    with _open(path, "r") as fp:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_write_out(path):
+    """Reassemble a write_out JSONL file for analysis.
+
+    :return: dict[int, list[dict]]
+        Records of every prompt index (None outside faireval runs), sorted by
+        doc_id like the former `{task_name}_write_out_info.json` lists
+    """
+    by_prompt = collections.defaultdict(list)
+    for record in read_write_out(path):
+        by_prompt[record.get("prompt_index")].append(record)
+    for records in by_prompt.values():
+        records.sort(key=lambda record: record["doc_id"])
+    return dict(by_prompt)
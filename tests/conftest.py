@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the evaluation modules are imported flat from src/, as src/eval.py does
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, os.path.join(SRC, "metrics", "BARTScore"))
+sys.path.insert(0, SRC)
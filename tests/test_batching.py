@@ -0,0 +1,27 @@
+from batching import plan_batches
+
+
+class FakeLM:
+    batch_size = None
+
+    def estimate_length(self, context):
+        return len(context)
+
+
+class FakeAPILM(FakeLM):
+    MIXED_BUDGETS = True
+
+
+REQUESTS = [
+    ("a long context", {"until": None, "max_length": 20}),
+    ("short", {"until": None, "max_length": 512}),
+    ("medium one", {"until": None, "max_length": 20}),
+]
+
+
+def test_generation_budgets_are_batched_apart():
+    assert plan_batches(FakeLM(), "greedy_until", REQUESTS) == [[0, 2], [1]]
+
+
+def test_api_backends_get_all_budgets_in_one_batch():
+    assert plan_batches(FakeAPILM(), "greedy_until", REQUESTS) == [[0, 2, 1]]
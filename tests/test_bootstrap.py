@@ -0,0 +1,66 @@
+import math
+import warnings
+
+import pytest
+
+from tasks import bootstrap
+from tasks import flare
+
+
+def mean_or_fail(items):
+    values = [item for item in items if item is not None]
+    if not values:
+        raise bootstrap.EmptyResample("Found array with 0 sample(s)")
+    return sum(values) / len(values)
+
+
+def fail(items):
+    raise TypeError("a bug in the metric")
+
+
+def test_parallel_bootstrap_skips_empty_resamples():
+    # most resamples of these items hold only missing values
+    items = [None] * 4 + [1.0]
+    with pytest.warns(UserWarning, match="skipped"):
+        stderr = bootstrap.parallel_bootstrap_stderr(mean_or_fail, items, iters=200, workers=2)
+    # the resamples that could be scored all average to 1.0
+    assert stderr == 0.0
+
+
+def test_parallel_bootstrap_all_empty_is_nan():
+    with pytest.warns(UserWarning, match="skipped 50 of 50"):
+        stderr = bootstrap.parallel_bootstrap_stderr(mean_or_fail, [None] * 5, iters=50, workers=2)
+    assert math.isnan(stderr)
+
+
+def test_parallel_bootstrap_raises_other_errors():
+    with pytest.raises(TypeError):
+        bootstrap.parallel_bootstrap_stderr(fail, [1.0, 2.0], iters=10, workers=2)
+
+
+def test_parallel_bootstrap_is_reproducible_for_any_number_of_workers():
+    items = [float(n) for n in range(20)]
+    stderrs = {
+        bootstrap.parallel_bootstrap_stderr(mean_or_fail, items, iters=100, workers=workers)
+        for workers in (1, 3)
+    }
+    assert len(stderrs) == 1
+
+
+def test_tsa_stderr():
+    task = flare.TSA.__new__(flare.TSA)
+    items = [(0.5, 0.2), (-0.3, 0.1), (0.8, 0.9), (0.0, -0.4), (0.6, 1.5)]
+    with warnings.catch_warnings():
+        # every resample has predictions, none is skipped
+        warnings.simplefilter("error")
+        stderr = bootstrap.parallel_bootstrap_stderr(task.rmse, items, iters=100, workers=2)
+    assert math.isfinite(stderr) and stderr > 0
+
+
+def test_tsa_stderr_with_missing_predictions():
+    task = flare.TSA.__new__(flare.TSA)
+    # resamples drawing only missing predictions have nothing to score
+    items = [(0.5, -100.0)] * 3 + [(0.5, 0.2), (-0.3, 0.1), (0.8, 0.9)]
+    with pytest.warns(UserWarning, match="bootstrap of rmse: skipped"):
+        stderr = bootstrap.parallel_bootstrap_stderr(task.rmse, items, iters=200, workers=2)
+    assert math.isfinite(stderr) and stderr > 0
@@ -0,0 +1,154 @@
+import http.server
+import json
+import threading
+import time
+
+import httpx
+import pytest
+
+from chatlm import ChatEngine, Endpoint, RateLimiter, char_length, stream_stop
+from tasks import flare
+
+
+class FakeChatServer(http.server.ThreadingHTTPServer):
+    """Local chat completions server answering "ok", or the queued error responses first.
+
+    Each queued response is a `(status, headers)` pair.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeChatHandler)
+        self.errors = []
+        self.received = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/chat/completions"
+
+
+class FakeChatHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.received.append(time.monotonic())
+        if self.server.errors:
+            status, headers = self.server.errors.pop(0)
+            body = b"{}"
+        else:
+            status, headers = 200, {}
+            body = json.dumps({"choices": [{"message": {"content": "ok"}}]}).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = FakeChatServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_engine(server, **kwargs):
+    endpoint = Endpoint(server.url, {}, limiter=RateLimiter())
+    return ChatEngine([endpoint], **kwargs)
+
+
+def test_stream_stop_waits_for_whole_answer_words():
+    task = flare.StockMovementACL.__new__(flare.StockMovementACL)
+    doc = {"choices": ["Rise", "Fall"], "gold": 0}
+    stop = lambda text: stream_stop(text, answer_words=task.answer_words(doc))
+
+    # "no" and "yes" are inside longer words
+    for text in ["I do not", "Not enough to know", "The economic", "Eyes on the announcement"]:
+        assert stop(text) is None
+    assert stop("No") == "No"
+    assert stop("Based on the news, yes") == "Based on the news, yes"
+    assert stop("The price will rise.") == "The price will rise."
+    # a newline still ends the first non-empty line
+    assert stop("\nI do not know\nmore") == "\nI do not know"
+
+
+def test_stream_stop_finds_chinese_answer_words_inside_text():
+    task = flare.ZHBigData.__new__(flare.ZHBigData)
+    doc = {"choices": ["上涨", "下跌"], "gold": 0}
+
+    assert stream_stop("股价将上涨", answer_words=task.answer_words(doc)) == "股价将上涨"
+
+
+def test_hedge_timer_starts_once_the_request_is_sent(server):
+    engine = make_engine(server, hedge_budget=1)
+    try:
+        # fast answers so far, but the rate limits hold the next request back
+        engine.latencies.extend([0.01] * ChatEngine.HEDGE_MIN_SAMPLES)
+        engine.pool.endpoints[0].limiter.pause(0.5)
+
+        assert engine.run([{"messages": []}]) == ["ok"]
+    finally:
+        engine.close()
+
+    assert engine.hedges_sent == 0
+    assert len(server.received) == 1
+
+
+def test_429_retry_after_pauses_the_limiter(server):
+    server.errors = [(429, {"retry-after": "0.3"})]
+    engine = make_engine(server, backoff_base=0.001)
+    try:
+        assert engine.run([{"messages": []}]) == ["ok"]
+    finally:
+        engine.close()
+
+    assert len(server.received) == 2
+    assert server.received[1] - server.received[0] >= 0.3
+
+
+def test_429_ratelimit_headers_pause_the_limiter(server):
+    server.errors = [
+        (
+            429,
+            {
+                "x-ratelimit-limit-requests": "6000",
+                "x-ratelimit-remaining-requests": "0",
+                "x-ratelimit-reset-requests": "300ms",
+            },
+        )
+    ]
+    engine = make_engine(server, backoff_base=0.001)
+    try:
+        assert engine.run([{"messages": []}]) == ["ok"]
+    finally:
+        engine.close()
+
+    limiter = engine.pool.endpoints[0].limiter
+    # the budget follows the reported limit, 6000 requests per minute
+    assert limiter.requests.rate == 100
+    assert server.received[1] - server.received[0] >= 0.3
+
+
+def test_429_retries_are_bounded(server):
+    server.errors = [(429, {"retry-after-ms": "10"})] * 10
+    engine = make_engine(server, max_retries=2)
+    try:
+        with pytest.raises(httpx.HTTPStatusError):
+            engine.run([{"messages": []}])
+    finally:
+        engine.close()
+
+    # the first attempt and two retries
+    assert len(server.received) == 3
+
+
+def test_char_length_counts_chinese_characters_as_tokens():
+    assert char_length("a" * 40) == 10
+    assert char_length("股价将上涨") == 5
+    assert char_length("Answer: 上涨") == 2 + 2
@@ -0,0 +1,69 @@
+import random
+
+import pytest
+from seqeval.metrics import f1_score
+
+from tasks import bootstrap
+from tasks.entities import counts_f1, entity_counts, entity_f1, entity_f1_stat, parse_label
+
+LABELS = ["O", "B-PER", "I-PER", "B-ORG", "I-ORG", "E-ORG", "S-LOC", "I-LOC"]
+
+
+def random_sentences(rnd, labels, n):
+    golds, preds = [], []
+    for _ in range(n):
+        length = rnd.randint(1, 8)
+        golds.append(rnd.choices(labels, k=length))
+        preds.append(rnd.choices(labels, k=length))
+    return golds, preds
+
+
+def test_entity_f1_matches_seqeval():
+    rnd = random.Random(0)
+    for _ in range(300):
+        golds, preds = random_sentences(rnd, LABELS, rnd.randint(1, 6))
+        expected = f1_score(golds, preds)
+        assert entity_f1(golds, preds) == pytest.approx(expected, abs=1e-12)
+        # NE tags never span two sentences, so the counts of each one add up
+        counts = [entity_counts(gold, pred) for gold, pred in zip(golds, preds)]
+        assert counts_f1(counts) == pytest.approx(expected, abs=1e-12)
+
+
+@pytest.mark.filterwarnings("ignore:.*seems not to be NE tag")
+def test_entity_f1_of_non_ne_tags_matches_seqeval():
+    rnd = random.Random(1)
+    # "PER" is no NE tag, its entities run on into the next sentence in seqeval
+    labels = ["O", "PER", "B-ORG", "I-ORG"]
+    for _ in range(100):
+        golds, preds = random_sentences(rnd, labels, rnd.randint(1, 6))
+        assert entity_f1(golds, preds) == pytest.approx(f1_score(golds, preds), abs=1e-12)
+
+
+def test_non_ne_tags_warn():
+    parse_label.cache_clear()
+    with pytest.warns(UserWarning, match="PER seems not to be NE tag"):
+        entity_f1([["PER", "O"]], [["PER", "PER"]])
+
+
+def test_entity_f1_rejects_sentences_of_different_lengths():
+    with pytest.raises(ValueError):
+        entity_f1([["O", "B-PER"]], [["O"]])
+
+
+def test_entity_f1_bootstrap_matches_the_parallel_bootstrap():
+    rnd = random.Random(2)
+    golds, preds = random_sentences(rnd, LABELS, 30)
+    items = list(zip(golds, preds))
+    counts = [entity_counts(gold, pred) for gold, pred in items]
+
+    stderr = bootstrap.counts_bootstrap_stderr(entity_f1_stat, counts, iters=50)
+
+    expected = bootstrap.parallel_bootstrap_stderr(
+        seqeval_f1, items, iters=50, workers=2
+    )
+    assert stderr == pytest.approx(expected, abs=1e-12)
+
+
+def seqeval_f1(items):
+    golds, preds = zip(*items)
+    return f1_score(list(golds), list(preds))
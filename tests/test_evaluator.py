@@ -0,0 +1,229 @@
+import os
+import types
+
+import lm_eval.base
+import lm_eval.models
+
+import evaluator
+import tasks as ta
+from journal import EvalJournal
+from tasks import flare
+
+
+class EchoLM(lm_eval.base.LM):
+    """LM that answers every greedy_until request with "1"."""
+
+    def __init__(self):
+        super().__init__()
+        self.contexts = []
+
+    def greedy_until(self, requests):
+        self.contexts.extend(context for context, _ in requests)
+        return ["1" for _ in requests]
+
+    def loglikelihood(self, requests):
+        raise NotImplementedError
+
+    def loglikelihood_rolling(self, requests):
+        raise NotImplementedError
+
+
+def make_task_class(cls, docs):
+    class FixtureTask(cls):
+        def download(self, *args, **kwargs):
+            self.dataset = {"train": docs, "validation": docs, "test": docs}
+
+    return FixtureTask
+
+
+def make_task(cls, docs):
+    return make_task_class(cls, docs)()
+
+
+def conv_doc(dialogue, turn, answer):
+    conversation = " ".join(
+        f"q{t} {{answer{t - 1}}}" if t else "q0" for t in range(turn + 1)
+    )
+    return {
+        "id": f"{dialogue}{turn}",
+        "query": f"Context: table {dialogue} Conversations: {conversation} Answer:",
+        "text": dialogue,
+        "answer": answer,
+        "dialogue_id": dialogue,
+        "turn": turn,
+    }
+
+
+def test_turns_of_dialogues_out_of_step_are_all_scored():
+    # dialogue B lost its first turn, e.g. to --limit, so A0 and B1 go out together
+    docs = [conv_doc("A", 0, "1"), conv_doc("A", 1, "1"), conv_doc("B", 1, "0")]
+    task = make_task(flare.ConvFinQA, docs)
+    scored = []
+    process_results = task.process_results
+    task.process_results = lambda doc, results: (
+        scored.append(doc["id"]) or process_results(doc, results)
+    )
+    lm = EchoLM()
+
+    results = evaluator.evaluate(
+        lm=lm, task_dict={"convfinqa": task}, bootstrap_iters=10
+    )
+
+    assert sorted(scored) == ["A0", "A1", "B1"]
+    assert results["results"]["convfinqa"]["acc"] == 2 / 3
+    # A1 is reformulated with the answer to A0
+    assert any("q1 1" in context for context in lm.contexts)
+
+
+def test_suite_tasks_journal_in_their_own_run_subdirectories(tmp_path, monkeypatch):
+    docs = [conv_doc("A", 0, "1"), conv_doc("A", 1, "1")]
+    monkeypatch.setitem(lm_eval.models.MODEL_REGISTRY, "echo", EchoLM)
+    for name in ("conv_a", "conv_b"):
+        monkeypatch.setitem(
+            ta.TASK_REGISTRY, name, make_task_class(flare.ConvFinQA, docs)
+        )
+    run_dir = str(tmp_path / "run")
+    entries = [
+        {"name": "conv_a", "run_dir": run_dir, "bootstrap_iters": 10},
+        {"name": "conv_b", "run_dir": run_dir, "bootstrap_iters": 10},
+    ]
+
+    def run_suite(**kwargs):
+        return {
+            entry["name"]: results["results"][entry["name"]]["acc"]
+            for entry, results in evaluator.simple_evaluate_suite(
+                entries,
+                "echo",
+                no_cache=True,
+                results_db=str(tmp_path / "results.db"),
+                **kwargs,
+            )
+        }
+
+    assert run_suite() == {"conv_a": 1.0, "conv_b": 1.0}
+    for name in ("conv_a", "conv_b"):
+        assert os.path.exists(os.path.join(run_dir, name, "journal.jsonl"))
+
+    # the rerun replays both journals without loading the model
+    monkeypatch.setitem(lm_eval.models.MODEL_REGISTRY, "echo", None)
+    assert run_suite(resume=run_dir) == {"conv_a": 1.0, "conv_b": 1.0}
+
+
+class BatchJobLM(EchoLM):
+    """EchoLM standing for a backend that sends its requests as batch jobs."""
+
+    batch = "local"
+    MIXED_BUDGETS = True
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self.request_origins = {}
+
+    def greedy_until(self, requests):
+        self.calls += 1
+        return super().greedy_until(requests)
+
+
+def test_batch_jobs_are_not_split_into_journal_chunks(tmp_path):
+    items = [
+        types.SimpleNamespace(
+            req=types.SimpleNamespace(args=(f"context {n}", {"until": None}), index=None),
+            origin=("echo", "task", n),
+            dialogue=None,
+        )
+        for n in range(5)
+    ]
+    lm = BatchJobLM()
+    journal = EvalJournal(str(tmp_path))
+
+    resps = evaluator.run_batch(
+        lm,
+        "greedy_until",
+        items,
+        journal=journal,
+        journal_key=lambda item: ("task", 0, item.origin[2], 0, 0),
+        chunk_size=2,
+    )
+    journal.close()
+
+    assert resps == ["1"] * 5
+    assert lm.calls == 1
+
+
+def label_doc(n, gold):
+    return {
+        "id": str(n),
+        "query": f"Sentence {n}. Answer:",
+        "text": f"Sentence {n}.",
+        "answer": ["positive", "neutral", "negative"][gold],
+        "choices": ["positive", "neutral", "negative"],
+        "gold": gold,
+    }
+
+
+def test_classification_docs_are_scored_in_one_batch():
+    docs = [label_doc(0, 0), label_doc(1, 1), label_doc(2, 0)]
+    task = make_task(flare.FPB, docs)
+    # the matcher of the choices is built with the task
+    assert list(task.choice_matchers) == [("positive", "neutral", "negative")]
+    batches = []
+    process_results_batch = task.process_results_batch
+    task.process_results_batch = lambda docs, results: (
+        batches.append(len(docs)) or process_results_batch(docs, results)
+    )
+
+    class PositiveLM(EchoLM):
+        def greedy_until(self, requests):
+            return ["\nPositive, mostly." for _ in requests]
+
+    results = evaluator.evaluate(
+        lm=PositiveLM(), task_dict={"fpb": task}, bootstrap_iters=10
+    )
+
+    assert batches == [3]
+    assert results["results"]["fpb"]["acc"] == 2 / 3
+    assert results["results"]["fpb"]["missing"] == 0
+
+
+class ChoiceLM(EchoLM):
+    """LM with fixed loglikelihoods of the FPB labels as continuations."""
+
+    LOGLIKELIHOODS = {" positive": -2.9, " neutral": -2.7, " negative": -4.0}
+
+    def loglikelihood(self, requests):
+        return [(self.LOGLIKELIHOODS[continuation], False) for _, continuation in requests]
+
+
+def test_registered_choice_task_ranks_choices_per_character(tmp_path, monkeypatch):
+    docs = [label_doc(0, 0), label_doc(1, 0), label_doc(2, 1)]
+    task_class = ta.TASK_REGISTRY["flare_fpb_choice"]
+    monkeypatch.setattr(
+        task_class,
+        "download",
+        lambda self, *args, **kwargs: setattr(
+            self, "dataset", {"train": docs, "validation": docs, "test": docs}
+        ),
+    )
+    monkeypatch.setitem(lm_eval.models.MODEL_REGISTRY, "choice", ChoiceLM)
+
+    results = evaluator.simple_evaluate(
+        model="choice",
+        tasks=["flare_fpb_choice"],
+        no_cache=True,
+        bootstrap_iters=10,
+        results_db=str(tmp_path / "results.db"),
+    )
+
+    # " neutral" has the highest sum, " positive" the highest per character
+    assert results["results"]["flare_fpb_choice"]["acc"] == 2 / 3
+
+    monkeypatch.setattr(task_class, "LENGTH_NORMALIZED", False, raising=False)
+    results = evaluator.simple_evaluate(
+        model="choice",
+        tasks=["flare_fpb_choice"],
+        no_cache=True,
+        bootstrap_iters=10,
+        results_db=str(tmp_path / "results.db"),
+    )
+    assert results["results"]["flare_fpb_choice"]["acc"] == 1 / 3
@@ -0,0 +1,27 @@
+from journal import EvalJournal
+
+
+def record(journal, doc_id, resp):
+    key = EvalJournal.key("task", None, doc_id, 0, 0)
+    journal.record([(key, doc_id, "greedy_until", (f"ctx {doc_id}", {}), resp)])
+
+
+def test_resume_after_torn_line_keeps_new_records(tmp_path):
+    journal = EvalJournal(tmp_path)
+    record(journal, 0, "a")
+    journal.close()
+    # a crash in the middle of writing the next record
+    with open(journal.path, "a", encoding="utf8") as fp:
+        fp.write('{"task": "task", "doc_')
+
+    journal = EvalJournal(tmp_path, resume=True)
+    assert len(journal.entries) == 1
+    record(journal, 1, "b")
+    journal.close()
+
+    journal = EvalJournal(tmp_path, resume=True)
+    journal.close()
+    assert journal.lookup(
+        EvalJournal.key("task", None, 1, 0, 0), "greedy_until", ("ctx 1", {})
+    ) == (True, "b")
+    assert len(journal.entries) == 2
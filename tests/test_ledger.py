@@ -0,0 +1,31 @@
+import datetime
+
+import pandas as pd
+
+from ledger import ResultsLedger
+
+
+def results_frame(value):
+    return pd.DataFrame(
+        [
+            {
+                "task_name": "faireval_fpb",
+                "metric": "acc",
+                "value": value,
+                "trial": 0,
+                "time": datetime.datetime(2024, 1, 1),
+            }
+        ]
+    )
+
+
+def test_rerun_without_model_replaces_its_rows(tmp_path):
+    path = str(tmp_path / "results.db")
+    ledger = ResultsLedger(path, run_id="run")
+    ledger.append(results_frame(0.5))
+    ResultsLedger(path, run_id="run").append(results_frame(0.75))
+
+    rows = ledger.query(run_id="run")
+    assert len(rows) == 1
+    assert rows.value.tolist() == [0.75]
+    assert rows.model.tolist() == [""]
@@ -0,0 +1,96 @@
+import random
+
+from tasks.utils import (
+    align_entities,
+    align_entities_batch,
+    parse_entities,
+    parse_entities_fingpt,
+    process_text,
+    process_text_fingpt,
+)
+from tasks.zhutils import parse_zhentities, process_zhtext
+
+
+def linear_scan_labels(text, entity_list):
+    """The labels of the original process_text, by a linear scan of the word offsets."""
+    text_words = text.split()
+    labels = ["O"] * len(text_words)
+    word_indices = [0]
+    for word in text_words[:-1]:
+        word_indices.append(word_indices[-1] + len(word) + 1)
+    for entity, entity_type in entity_list:
+        start = 0
+        while True:
+            start = text.find(entity, start)
+            if not entity or start == -1:
+                break
+            end = start + len(entity) - 1
+            try:
+                start_word = next(i for i, ind in enumerate(word_indices) if ind >= start)
+                end_word = next(i for i, ind in enumerate(word_indices) if ind > end)
+                labels[start_word] = "B-" + entity_type
+                for i in range(start_word + 1, end_word):
+                    labels[i] = "I-" + entity_type
+            except Exception:
+                pass
+            start = end + 1
+    return labels
+
+
+CASES = [
+    # an entity inside a longer word labels the next word
+    ("Apple, ORG", "The Pineapple Company bought Apple Inc today"),
+    # repeated whitespace shifts the offsets of the words after it
+    ("Acme Corp, ORG\nJohn, PER", "Acme  Corp hired John   Smith in   Boston ."),
+    # repeated entity, an entity in the last word and an empty line
+    ("Bank, ORG\n\nBoston, LOC", "Bank of Boston and Bank of Boston"),
+    ("New York, LOC\nYork, ORG", "New York and York Group sued New York"),
+]
+
+
+def test_process_text_matches_the_linear_scan():
+    for response, text in CASES:
+        assert process_text(response, text) == linear_scan_labels(
+            text, parse_entities(response)
+        )
+
+
+def test_process_text_fingpt_matches_the_linear_scan():
+    response = "Apple is an organization, John Smith is a person, Boston is a location."
+    text = "John Smith  of Apple flew to Boston today"
+    assert process_text_fingpt(response, text) == linear_scan_labels(
+        text, parse_entities_fingpt(response)
+    )
+
+
+def test_process_zhtext_matches_the_linear_scan():
+    for response, text in [
+        ("中国银行,ORG", "今 天 中 国 银 行 发 布 公 告"),
+        ("银行,ORG", "银 行 与 银 行 合 作 银 行"),
+        ("张三", "张 三 是 张 三 丰 的 学 生"),
+    ]:
+        assert process_zhtext(response, text) == linear_scan_labels(
+            text, parse_zhentities(response)
+        )
+
+
+def test_align_entities_batch_matches_each_doc():
+    rnd = random.Random(0)
+    vocabulary = ["Acme", "Corp", "Bank", "of", "Boston", "ac", "me", "中", "国"]
+    texts, entity_lists = [], []
+    for _ in range(200):
+        words = rnd.choices(vocabulary, k=rnd.randint(1, 12))
+        text = "".join(word + " " * rnd.randint(1, 3) for word in words).strip()
+        entities = [
+            (" ".join(rnd.choices(vocabulary, k=rnd.randint(1, 2))), rnd.choice(["ORG", "LOC"]))
+            for _ in range(rnd.randint(0, 4))
+        ]
+        # texts repeat, as the docs of several prompts
+        for _ in range(rnd.randint(1, 2)):
+            texts.append(text)
+            entity_lists.append(entities)
+
+    batch = align_entities_batch(texts, entity_lists)
+
+    assert batch == [align_entities(t, e) for t, e in zip(texts, entity_lists)]
+    assert batch == [linear_scan_labels(t, e) for t, e in zip(texts, entity_lists)]